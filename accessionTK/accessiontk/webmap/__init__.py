@@ -1,18 +1,24 @@
 #!/usr/bin/env
 from sys import stderr
-from PIL import Image
+from PIL import Image, ImageOps, ExifTags
 try:
     import HeifImagePlugin
 except ImportError:
     print("Failed to load HeifImagePlugin. *.HEIF won't be supported.", file=stderr)
+try:
+    import pillow_avif # AVIF support for Pillow < 11.3
+except ImportError:
+    pass
 from tqdm import tqdm
 
 import argparse
 from pathlib import Path
 from csv import DictReader
-from glob import glob
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
 import json
+import os
 import os.path
 try:
     import importlib.resources as pkg_resources
@@ -20,27 +26,254 @@ except ImportError:
     import importlib_resources as pkg_resources
 
 
-def write_images(outprefix: str, srcpath: Path, widths: dict[str, int] = {"thumb": 200, "large": 1920}) -> list[str]:
-    outpaths = {}
+DEFAULT_WIDTHS = {"thumb": 200, "large": 1920}
+
+
+# Pillow format name and save() options for each output image type.
+# Progressive JPEGs show a preview while the large images load.
+IMAGE_FORMATS = {
+    "jpg": ("JPEG", {"optimize": True, "progressive": True}),
+    "webp": ("WEBP", {"method": 4}),
+    "avif": ("AVIF", {}),
+}
+
+
+def image_outpaths(outprefix: str, widths: dict[str, int] = DEFAULT_WIDTHS, fmt: str = "jpg") -> dict[str, str]:
+    return {size: f"{outprefix}_{size}.{fmt}" for size in widths}
+
+
+def fit_size(w: int, h: int, width: int) -> tuple[int, int]:
+    """Size of a w x h image scaled so its longer side is at most width (0 for the original size)."""
+    if width == 0: # use 0 as width to preserve original dimensions
+        return w, h
+    if w > h: # "width" acutally means the longer dimensions, which for portrait pics is height
+        nw = min(w, width)
+        nh = round(nw/w*h)
+    else:
+        nh = min(h, width)
+        nw = round(nh/h*w)
+    return nw, nh
+
+
+def write_images(outprefix: str, srcpath: Path, widths: dict[str, int] = DEFAULT_WIDTHS,
+                 fmt: str = "jpg", quality: int = None) -> dict[str, str]:
+    outpaths = image_outpaths(outprefix, widths, fmt)
+    pilformat, options = IMAGE_FORMATS[fmt]
+    if quality is not None:
+        options = dict(options, quality=quality)
     src = Image.open(srcpath)
-    for size, width in widths.items():
-        if width == 0: # use 0 as width to preserve original dimensions
-            resized = src.copy()
-        else:
-            w, h = src.width, src.height
-            if w > h: # "width" acutally means the longer dimensions, which for portrait pics is height
-                nw = min(w, width)
-                nh = round(nw/w*h)
-            else:
-                nh = min(h, width)
-                nw = round(nh/h*w)
-            resized = src.resize((nw, nh), Image.LANCZOS)
-        outfile = f"{outprefix}_{size}.jpg"
-        outpaths[size] = outfile
-        resized.save(outfile)
+    # Output sizes are relative to the full resolution, upright image, even
+    # if it's decoded at a smaller scale below
+    fullw, fullh = src.size
+    if src.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+        fullw, fullh = fullh, fullw
+    # Largest first, so that each smaller image is resized from the one before
+    sizes = sorted(widths, key=lambda size: widths[size] or float("inf"), reverse=True)
+    largest = widths[sizes[0]]
+    if largest != 0:
+        # Let JPEGs decode at a reduced scale that's still at least as big as
+        # the largest output. A no-op for other formats.
+        src.draft("RGB", fit_size(src.width, src.height, largest))
+    img = ImageOps.exif_transpose(src)
+    if pilformat == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    for size in sizes:
+        nw, nh = fit_size(fullw, fullh, widths[size])
+        if img.size != (nw, nh):
+            img = img.resize((nw, nh), Image.LANCZOS)
+        img.save(outpaths[size], pilformat, **options)
     return outpaths
 
 
+def write_all_images(tasks, threads=1):
+    """Run write_images(*task) for each task, on `threads` processes. Only a
+    few tasks per process are queued at once, so that memory use doesn't
+    grow with the number of images."""
+    if threads <= 1:
+        for task in tqdm(tasks, unit="images"):
+            write_images(*task)
+        return
+    with ProcessPoolExecutor(threads) as pool, tqdm(total=len(tasks), unit="images") as progress:
+        pending = set()
+        for task in tasks:
+            if len(pending) >= 2*threads:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update()
+            pending.add(pool.submit(write_images, *task))
+        for future in pending:
+            future.result()
+            progress.update()
+
+
+def image_extensions() -> set[str]:
+    """File extensions (lower case, with the dot) of images Pillow can open."""
+    Image.init()
+    return {ext for ext, fmt in Image.registered_extensions().items() if fmt in Image.OPEN}
+
+
+def _list_images(dirpath, extensions):
+    with os.scandir(dirpath) as it:
+        return sorted(Path(entry.path) for entry in it
+                      if not entry.name.startswith(".") and entry.is_file()
+                      and os.path.splitext(entry.name)[1].lower() in extensions)
+
+
+def index_source_images(srcimgdir, threads=os.cpu_count()) -> dict[str, list[Path]]:
+    """Map the name of each directory in srcimgdir to the image files directly
+    within it, in order of filename. Directories are listed on `threads`
+    threads, as on network file systems most of the time is spent waiting."""
+    extensions = image_extensions()
+    with os.scandir(srcimgdir) as it:
+        dirs = [(entry.name, entry.path) for entry in it
+                if not entry.name.startswith(".") and entry.is_dir()]
+    with ThreadPoolExecutor(threads) as pool:
+        images = pool.map(_list_images, [path for _, path in dirs], [extensions]*len(dirs))
+        return {name: imgs for (name, _), imgs in zip(dirs, images)}
+
+
+def report_unmatched(label, names, limit=10):
+    names = sorted(names)
+    if names:
+        more = f", and {len(names) - limit} more" if len(names) > limit else ""
+        print(f"WARNING: {len(names)} {label}: {', '.join(names[:limit])}{more}", file=stderr)
+
+
+def file_digest(path, bufsize=1<<20):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as fh:
+        while True:
+            buf = fh.read(bufsize)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def write_if_changed(path, text):
+    """Write text to path, unless the file already holds exactly that text.
+    Returns True if the file was written."""
+    try:
+        with open(path) as fh:
+            if fh.read() == text:
+                return False
+    except OSError:
+        pass
+    with open(path, "w") as fh:
+        fh.write(text)
+    return True
+
+
+def write_localities(outdir, localities):
+    """Write localities.json, a compact index of each locality's coordinates,
+    and the rest of each locality's details (description, images and
+    individuals) to a file per locality under localities/, which the map
+    loads when a locality is clicked. Detail files of localities that no
+    longer exist are deleted."""
+    detaildir = Path(outdir) / "localities"
+    detaildir.mkdir(exist_ok=True)
+    index = {}
+    details = set()
+    for name, locality in localities.items():
+        # Named by a hash, as locality names can contain anything
+        detail = f"localities/{hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]}.json"
+        details.add(detail)
+        index[name] = {"lat": locality["lat"], "lon": locality["lon"], "detail": detail}
+        write_if_changed(Path(outdir) / detail, json.dumps(locality, indent=2) + "\n")
+    for path in detaildir.glob("*.json"):
+        if f"localities/{path.name}" not in details:
+            path.unlink()
+    write_if_changed(Path(outdir) / "localities.json", json.dumps(index, separators=(",", ":")) + "\n")
+
+
+class BuildManifest(object):
+    """Record of the source of every image derivative in an output directory,
+    so that a rebuild only needs to redo images whose source has changed.
+
+    Entries are keyed by output prefix (relative to the output directory), and
+    hold the source path, size, mtime, content hash and the widths, format
+    and quality written.
+    A source whose size or mtime has changed but whose hash hasn't (e.g. it
+    was copied or touched) isn't redone.
+    """
+    FILENAME = ".webmap-manifest.json"
+    # Bump whenever write_images' output changes, to rewrite every image
+    VERSION = 2
+
+    def __init__(self, outdir):
+        self.outdir = Path(outdir)
+        self.path = self.outdir / self.FILENAME
+        self.images = {}
+        try:
+            with open(self.path) as fh:
+                manifest = json.load(fh)
+            if manifest.get("version") == self.VERSION:
+                self.images = manifest["images"]
+        except (OSError, ValueError):
+            pass
+        self._new = {}
+
+    def key(self, outprefix):
+        return str(Path(outprefix).relative_to(self.outdir))
+
+    def stale(self, tasks, force=False):
+        """The write_images tasks whose outputs are missing or out of date."""
+        stale = []
+        for outprefix, srcpath, widths, fmt, quality in tasks:
+            key = self.key(outprefix)
+            st = os.stat(srcpath)
+            entry = self.images.get(key)
+            new = {"src": str(srcpath), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                   "widths": widths, "format": fmt, "quality": quality}
+            if entry is not None and not force \
+                    and all(entry[k] == new[k] for k in ("src", "widths", "format", "quality")) \
+                    and all(os.path.exists(p) for p in image_outpaths(outprefix, widths, fmt).values()):
+                if entry["size"] == new["size"] and entry["mtime_ns"] == new["mtime_ns"]:
+                    new["hash"] = entry["hash"]
+                    self._new[key] = new
+                    continue
+                new["hash"] = file_digest(srcpath)
+                if new["hash"] == entry["hash"]:
+                    self._new[key] = new
+                    continue
+            else:
+                new["hash"] = file_digest(srcpath)
+            self._new[key] = new
+            stale.append((outprefix, srcpath, widths, fmt, quality))
+        return stale
+
+    def remove_orphans(self):
+        """Delete derivatives from earlier builds that this build didn't make."""
+        keep = set()
+        for key, entry in self._new.items():
+            keep.update(image_outpaths(self.outdir / key, entry["widths"], entry["format"]).values())
+        removed = 0
+        for key, entry in self.images.items():
+            for path in image_outpaths(self.outdir / key, entry["widths"], entry["format"]).values():
+                if path in keep:
+                    continue
+                try:
+                    os.unlink(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass  # not empty
+        return removed
+
+    def save(self):
+        """Replace the manifest with the entries of this build."""
+        self.images = self._new
+        self._new = {}
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as fh:
+            json.dump({"version": self.VERSION, "images": self.images}, fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
 def load_file_or_get_text(fileortext):
     if os.path.exists(fileortext):
         with open(fileortext) as fh:
@@ -70,6 +303,14 @@ def main():
             help="Extra content for end of javascript source. Give text or path.")
     ap.add_argument("--image-width", default=1920, type=int,
             help="Width of 'large' images in output. Use 0 for original size")
+    ap.add_argument("--image-format", default="jpg", choices=list(IMAGE_FORMATS),
+            help="Format of output images (default: jpg)")
+    ap.add_argument("--quality", type=int,
+            help="Quality of output images, 0-100 (default: Pillow's default for the format)")
+    ap.add_argument("--threads", "-j", default=os.cpu_count(), type=int,
+            help="Number of processes resizing images, and threads listing source image directories (default: number of CPUs)")
+    ap.add_argument("--force", action="store_true",
+            help="Rewrite every image, even those unchanged since the last build")
     ap.add_argument("--outdir", "-o", required=True,
             help="Output directory.")
     ap.add_argument("--srcimgdir", "-i", required=True,
@@ -77,11 +318,17 @@ def main():
     ap.add_argument("--indiv-table", "-t", required=True,
             help="Table of individuals as .csv or .tsv (delimiter must match filename).")
     args = ap.parse_args()
+    Image.init()
+    if IMAGE_FORMATS[args.image_format][0] not in Image.SAVE:
+        ap.error(f"This Pillow can't write {args.image_format} images")
 
     localities = {}
     outdir = Path(args.outdir)
     outdir.mkdir(exist_ok=True, parents=True)
     widths = {"thumb": 200, "large": args.image_width}
+    image_tasks = []
+
+    srcimgs_by_dir = index_source_images(args.srcimgdir, threads=args.threads)
 
     dialect = "excel" if str(args.indiv_table).endswith(".csv") else "excel-tab"
     with open(args.indiv_table) as fh:
@@ -90,11 +337,11 @@ def main():
             indiv_out = {}
             name = indiv[args.individual_colname]
             outimgs = []
-            srcimgs = glob(f"{str(args.srcimgdir)}/{name}/*.*")
-            for i, srcimg in enumerate(map(Path, srcimgs)):
+            for i, srcimg in enumerate(srcimgs_by_dir.get(name, [])):
                 outimgprefix = Path(f"{outdir}/{name}/{i+1:03d}")
                 outimgprefix.parent.mkdir(exist_ok=True, parents=True)
-                images = write_images(outimgprefix, srcimg, widths)
+                image_tasks.append((outimgprefix, srcimg, widths, args.image_format, args.quality))
+                images = image_outpaths(outimgprefix, widths, args.image_format)
                 images_pathfix = {k: str(Path(v).relative_to(outdir)) for k, v in images.items()}
                 outimgs.append(images_pathfix)
             loc = indiv[args.locality_colname]
@@ -114,18 +361,33 @@ def main():
                     "individuals": [indiv_out,],
                 }
         for locality in tqdm(localities):
-            srcimgs = glob(f"{str(args.srcimgdir)}/{locality}/*.*")
             outimgs = []
-            for i, srcimg in enumerate(map(Path, srcimgs)):
+            for i, srcimg in enumerate(srcimgs_by_dir.get(locality, [])):
                 outimgprefix = Path(f"{outdir}/{locality}/{i+1:03d}")
                 outimgprefix.parent.mkdir(exist_ok=True, parents=True)
-                images = write_images(outimgprefix, srcimg)
+                # Locality images always use the default sizes
+                image_tasks.append((outimgprefix, srcimg, DEFAULT_WIDTHS, args.image_format, args.quality))
+                images = image_outpaths(outimgprefix, DEFAULT_WIDTHS, args.image_format)
                 images_pathfix = {k: str(Path(v).relative_to(outdir)) for k, v in images.items()}
                 outimgs.append(images_pathfix)
             localities[locality]["images"] = outimgs
 
-    with open(outdir / "localities.json", "w") as jf:
-        print(json.dumps(localities, indent=2), file=jf)
+    names = {indiv[args.individual_colname] for indiv in indivs}
+    report_unmatched("individuals have no images", {name for name in names if not srcimgs_by_dir.get(name)})
+    report_unmatched("image directories match no individual or locality", set(srcimgs_by_dir) - names - set(localities))
+
+    # Output paths are all fixed above, so the images can be written in any
+    # order and the result is the same as writing them one by one.
+    manifest = BuildManifest(outdir)
+    stale = manifest.stale(image_tasks, force=args.force)
+    print(f"{len(stale)} of {len(image_tasks)} images need (re)writing", file=stderr)
+    write_all_images(stale, threads=args.threads)
+    removed = manifest.remove_orphans()
+    if removed:
+        print(f"Removed {removed} images whose source is gone", file=stderr)
+    manifest.save()
+
+    write_localities(outdir, localities)
 
     extra_header = ""
     if args.extra_header is not None:
@@ -138,15 +400,13 @@ def main():
         extra_js = load_file_or_get_text(args.extra_js)
 
     html = pkg_resources.read_text("accessiontk.webmap", 'index.html')
-    with open(outdir / "index.html", "w") as hf:
-        html = html.replace("__EXTRA_HEADER__", extra_header)
-        html = html.replace("__EXTRA_FOOTER__", extra_footer)
-        hf.write(html)
+    html = html.replace("__EXTRA_HEADER__", extra_header)
+    html = html.replace("__EXTRA_FOOTER__", extra_footer)
+    write_if_changed(outdir / "index.html", html)
 
     js = pkg_resources.read_text("accessiontk.webmap", 'mapapp.js')
-    with open(outdir / "mapapp.js", "w") as jf:
-        js = js.replace("__EXTRA_JS__", extra_js)
-        jf.write(js)
+    js = js.replace("__EXTRA_JS__", extra_js)
+    write_if_changed(outdir / "mapapp.js", js)
 
 
 if __name__ == "__main__":
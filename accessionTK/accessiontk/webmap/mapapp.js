@@ -15,12 +15,15 @@ var osm_basemap = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.pn
 
 var Lmap = null;
 var Lmarkers = null
+// Promises of each locality's details, by locality name
+var details = new Map();
 
 var vuem = createApp({
     data() { return {
         current_basemap: "osm",
         localities: null,
         current_locality: false,
+        locality: null,
     }},
     methods: {
         async onSwitchBasemap(e) {
@@ -47,6 +50,19 @@ var vuem = createApp({
             $('#maintable').css({"max-height": "40%"});
             setTimeout(function(){ Lmap.invalidateSize()}, 200);
         },
+        async onSelectLocality(name) {
+            // Details are only fetched when first needed, so the map can
+            // show all localities without loading every individual
+            const vm = this;
+            if (!details.has(name)) {
+                details.set(name, fetch(vm.localities[name].detail)
+                    .then(response => response.json())
+                    .catch(error => { details.delete(name); throw error; }));
+            }
+            const locality = await details.get(name);
+            vm.locality = locality;
+            vm.current_locality = name;
+        },
         async onNoMap(e) {
             $('#mapdiv').css({display: "none"})
             $('#maintable').css({"max-height": "100%"});
@@ -64,16 +80,19 @@ var vuem = createApp({
                 Lmarkers = L.markerClusterGroup();
 
 
-                Object.values(vm.localities)
-                .forEach(function(p) {
+                Object.entries(vm.localities)
+                .forEach(function([name, p]) {
                     var marker = L.marker([p.lat, p.lon])
                         .on('click', function (e) {
-                            vm.current_locality = p.locality_name;
-                            $('#mapdiv').css({height: "60%", "display": "block"});
-                            $('#maintable').css({"max-height": "40%"});
-                            setTimeout(function(){ Lmap.invalidateSize()}, 200);
+                            vm.onSelectLocality(name)
+                            .then(() => {
+                                $('#mapdiv').css({height: "60%", "display": "block"});
+                                $('#maintable').css({"max-height": "40%"});
+                                setTimeout(function(){ Lmap.invalidateSize()}, 200);
+                            })
+                            .catch(error => console.log(error));
                         })
-                       .bindTooltip(p.locality_name, { permanent: true, direction: 'right' });
+                       .bindTooltip(name, { permanent: true, direction: 'right' });
                     Lmarkers.addLayer(marker);
                 });
 
@@ -9,19 +9,53 @@ import json
 from flask import Flask, request, abort, jsonify, send_from_directory, current_app, redirect, send_file
 
 from .scanimages import ImgData, dataURI_to_file
+from .thumbnails import ThumbnailDir
+from .jobs import JobManager, JobError
+from .labelcache import LabelCache
 from . import labelmaker
-from io import BytesIO
+from tempfile import SpooledTemporaryFile, gettempdir
+import os.path
+import shutil
 import re
+import time
 
 app = Flask("qrmagic")
 
-app.config.from_prefixed_env("QRMAGIC_")
+app.config.from_prefixed_env("QRMAGIC")
 if app.config.get("USE_WHITENOISE", False):
     from whitenoise import WhiteNoise
     app.wsgi_app = WhiteNoise(app.wsgi_app, root='static/')
 from whitenoise import WhiteNoise
 app.wsgi_app = WhiteNoise(app.wsgi_app, root='static/')
 
+# If QRMAGIC_THUMBNAIL_DIR is set, preview images from /api/scan-image are
+# kept there and returned as URLs, rather than as data URIs. They're deleted
+# a week after they were last stored, or sooner once the directory is full.
+THUMBNAILS = None
+if app.config.get("THUMBNAIL_DIR"):
+    THUMBNAILS = ThumbnailDir(app.config["THUMBNAIL_DIR"], url_prefix="/api/thumbnail/",
+                              ttl=float(app.config.get("THUMBNAIL_TTL", 7*24*3600)),
+                              max_bytes=int(app.config.get("THUMBNAIL_MAX_BYTES", 1<<30)))
+
+JOBS = JobManager(
+    app.config.get("JOB_DIR", os.path.join(gettempdir(), "qrmagic-jobs")),
+    workers=int(app.config.get("JOB_WORKERS", 2)),
+    max_job_images=int(app.config.get("JOB_MAX_IMAGES", 2000)),
+    max_pending=int(app.config.get("JOB_MAX_PENDING", 10000)),
+    ttl=float(app.config.get("JOB_TTL", 24*3600)),
+    stall_timeout=float(app.config.get("JOB_STALL_TIMEOUT", 600)),
+    thumbnails=THUMBNAILS,
+)
+
+# Rendered label PDFs, so that repeated requests for the same labels are
+# just a file send.
+LABEL_CACHE = LabelCache(
+    app.config.get("LABEL_CACHE_DIR", os.path.join(gettempdir(), "qrmagic-labels")),
+    max_bytes=int(app.config.get("LABEL_CACHE_MAX_BYTES", 512<<20)),
+)
+MAX_LABEL_IDS = int(app.config.get("MAX_LABEL_IDS", 20000))
+MAX_LABEL_COPIES = int(app.config.get("MAX_LABEL_COPIES", 100))
+
 @app.route("/")
 def redir_index():
     return redirect("/index.html", 301)
@@ -31,7 +65,83 @@ def redir_index():
 def scan_image():
     jsondat = json.loads(request.data)
     img = ImgData(filename = jsondat.get("filename"), data = dataURI_to_file(jsondat.get("content")))
-    return jsonify(img.as_response_json()), 201
+    return jsonify(img.as_response_json(THUMBNAILS)), 201
+
+
+def spool_upload(stream, max_memory=8<<20):
+    """Copy a non-seekable upload stream into a seekable file, which only
+    goes to disk if it is larger than max_memory bytes."""
+    spool = SpooledTemporaryFile(max_size=max_memory)
+    shutil.copyfileobj(stream, spool)
+    spool.seek(0)
+    return spool
+
+
+@app.route("/api/scan-image-file", methods=["POST"])
+def scan_image_file():
+    """Scan one image sent either as a multipart upload (field 'image') or
+    as the raw request body (with ?filename=...), avoiding the base64 data
+    URI round trip of /api/scan-image."""
+    if "image" in request.files:
+        upload = request.files["image"]
+        img = ImgData(filename=upload.filename, data=upload.stream)
+    else:
+        filename = request.args.get("filename", request.headers.get("X-Filename"))
+        if not filename:
+            abort(400, "Give the image's filename as ?filename=")
+        with spool_upload(request.stream) as data:
+            img = ImgData(filename=filename, data=data)
+    return jsonify(img.as_response_json(THUMBNAILS)), 201
+
+
+@app.route("/api/scan-images", methods=["POST"])
+def scan_images():
+    """Scan many images from one multipart upload (repeated field 'images'),
+    returning a list of results in upload order."""
+    results = []
+    for upload in request.files.getlist("images"):
+        img = ImgData(filename=upload.filename, data=upload.stream)
+        results.append(img.as_response_json(THUMBNAILS))
+        upload.close()
+    return jsonify(results), 201
+
+
+@app.errorhandler(JobError)
+def job_error(exc):
+    resp = jsonify({"error": str(exc)})
+    resp.status_code = exc.status
+    if exc.status == 429:
+        resp.headers["Retry-After"] = "30"
+    return resp
+
+
+@app.route("/api/jobs", methods=["POST"])
+def create_job():
+    """Submit a batch of images (repeated multipart field 'images') to be
+    scanned in the background. Poll /api/jobs/<id> for progress."""
+    job_id = JOBS.create(request.files.getlist("images"))
+    return jsonify({"id": job_id, "url": f"/api/jobs/{job_id}"}), 202
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Progress and results of a job. Give ?since=N to only get results after
+    the first N, e.g. the number of results already received."""
+    return jsonify(JOBS.status(job_id, since=request.args.get("since", 0, type=int)))
+
+
+@app.route("/api/jobs/<job_id>", methods=["DELETE"])
+def delete_job(job_id):
+    JOBS.delete(job_id)
+    return "", 204
+
+
+@app.route("/api/thumbnail/<path:name>", methods=["GET"])
+def thumbnail(name):
+    if THUMBNAILS is None:
+        abort(404)
+    # Thumbnails are named by their content hash, so can be cached forever
+    return send_from_directory(THUMBNAILS.path, name, mimetype="image/jpeg", max_age=365*24*3600)
 
 
 @app.route("/api/labeltypes.json", methods=["GET"])
@@ -39,21 +149,85 @@ def labeltypes():
     return jsonify(labelmaker.labeltype_json), 201
 
 
+def send_labels(key, fh):
+    # Sent from the open file, as another process may evict the cached PDF
+    # at any time
+    size = os.fstat(fh.fileno()).st_size
+    resp = send_file(fh, mimetype="application/pdf", as_attachment=True, download_name="labels.pdf",
+                     etag=key, max_age=365*24*3600)
+    resp.content_length = size
+    # send_file can't tell the size of a file object, so can't handle ranges
+    resp = resp.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    resp.headers["Content-Location"] = f"/api/labels_pdf/{key}"
+    return resp
+
+
+def int_param(jsondat, name, default):
+    try:
+        return int(jsondat.get(name, default))
+    except (TypeError, ValueError):
+        abort(400, f"{name} must be a whole number")
+
+
 @app.route("/api/labels_pdf", methods=["POST"])
 def labels_pdf():
+    """Render (or fetch from the cache) a PDF of labels. The PDF is written
+    to disk as it is rendered, never held in memory, and then streamed from
+    the file."""
     jsondat = json.loads(request.data)
     if jsondat.get("ids_txt"):
         ids = [x.strip() for x in re.split(r"[\t\n]+", jsondat.get("ids_txt").rstrip())]
     else:
-        ids = [jsondat["id_format"].format(i) for i in range(int(jsondat.get("id_start", 1)), int(jsondat.get("id_end", 100))+1)]
+        id_start, id_end = int_param(jsondat, "id_start", 1), int_param(jsondat, "id_end", 100)
+        if id_end < id_start:
+            abort(400, "id_end must not be less than id_start")
+        # Check the size of the range before making a list of it
+        if id_end - id_start + 1 > MAX_LABEL_IDS:
+            abort(413, f"Too many IDs (at most {MAX_LABEL_IDS} per request)")
+        ids = [jsondat["id_format"].format(i) for i in range(id_start, id_end+1)]
+    if len(ids) > MAX_LABEL_IDS:
+        abort(413, f"Too many IDs (at most {MAX_LABEL_IDS} per request)")
 
     labelclass = labelmaker.label_types[jsondat.get("label_type", "L3666")]
+    labeltype = labelclass(layout=jsondat.get("layout"), line_delim=",")
+    copies = int_param(jsondat, "copies", 1)
+    border = bool(jsondat.get("border", False))
+    if copies < 1:
+        abort(400, "copies must be at least 1")
+    if copies > MAX_LABEL_COPIES:
+        abort(413, f"Too many copies (at most {MAX_LABEL_COPIES} per label)")
+
+    key = LABEL_CACHE.key({"ids": ids, "label_type": labelclass.name, "layout": labeltype.layout,
+                           "copies": copies, "border": border})
+    pdf = LABEL_CACHE.get(key)
+    if pdf is not None and key in request.if_none_match:
+        pdf.close()
+        return "", 304, {"ETag": f'"{key}"', "Content-Location": f"/api/labels_pdf/{key}"}
+    cached = pdf is not None
+    render_time = 0.0
+    if not cached:
+        start = time.monotonic()
+        pdf = LABEL_CACHE.put(key, lambda fh: labelmaker.generate_labels(labeltype, ids, copies=copies, border=border, output=fh))
+        render_time = time.monotonic() - start
+
+    n_labels = len(ids) * copies
+    per_page = labelclass.page["rows"] * labelclass.page["columns"]
+    resp = send_labels(key, pdf)
+    resp.headers["X-Cache"] = "hit" if cached else "miss"
+    resp.headers["X-Render-Time"] = f"{render_time:.3f}"
+    resp.headers["X-Label-Count"] = str(n_labels)
+    resp.headers["X-Page-Count"] = str(-(-n_labels // per_page))
+    return resp
+
 
-    sht = labelmaker.generate_labels(labelclass(layout=jsondat.get("layout"), line_delim=","), ids, copies=jsondat.get("copies", 1), border=jsondat.get("border", False))
-    pdf = BytesIO()
-    sht.save(pdf)
-    pdf.seek(0)
-    return send_file(pdf, mimetype="application/pdf", as_attachment=True, download_name="labels.pdf", max_age=0.1)
+@app.route("/api/labels_pdf/<key>", methods=["GET"])
+def cached_labels_pdf(key):
+    """A previously rendered label PDF, as named by the ETag and
+    Content-Location of a /api/labels_pdf response."""
+    pdf = LABEL_CACHE.get(key)
+    if pdf is None:
+        abort(404)
+    return send_labels(key, pdf)
 
 
 if __name__ == "__main__":
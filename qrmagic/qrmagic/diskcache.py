@@ -0,0 +1,44 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+
+
+def evict_lru(path, max_bytes=None, ttl=None, keep=None):
+    """Delete files from the subdirectories of `path` (as used by the label
+    and thumbnail caches) not touched in the last `ttl` seconds, then the
+    least recently touched until the rest fit in `max_bytes`. The file at
+    `keep`, if given, is never deleted."""
+    now = time.time()
+    files = []
+    total = 0
+    for subdir in os.scandir(path):
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(".tmp") and st.st_mtime > now - 3600:
+                # Probably still being written by another process
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+    files.sort()
+    for mtime, size, filepath in files:
+        expired = ttl is not None and mtime < now - ttl
+        if not expired and (max_bytes is None or total <= max_bytes):
+            break
+        if filepath == keep:
+            continue
+        try:
+            os.unlink(filepath)
+        except OSError:
+            pass
+        total -= size
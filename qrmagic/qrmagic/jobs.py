@@ -0,0 +1,255 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from .scanimages import ImgData, LOG
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from uuid import uuid4
+import json
+import os
+import re
+import shutil
+import socket
+import struct
+import threading
+import time
+
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class JobError(Exception):
+    status = 400
+
+
+class JobTooLarge(JobError):
+    status = 413
+
+
+class ServerBusy(JobError):
+    status = 429
+
+
+class NoSuchJob(JobError):
+    status = 404
+
+
+def _scan_job_image(path, filename, thumbnails):
+    with open(path, "rb") as fh:
+        img = ImgData(filename=filename, data=fh)
+    return img.as_response_json(thumbnails)
+
+
+class JobManager(object):
+    """Batch image scanning jobs, run on a process pool shared by all
+    requests to this server process.
+
+    All job state lives in a directory per job (uploaded images, meta.json,
+    results.ndjson, and results.idx of each result's byte offset), so any
+    server process can report on any job. The queue of images still to
+    scan, however, is only held by the process that created the job.
+    meta.json records that process, so that if it dies or is reloaded, other
+    processes report the job as failed rather than unfinished forever; so
+    does a job that makes no progress for `stall_timeout` seconds.
+
+    Each job only has `max_inflight` images queued on the pool at once, so
+    one large job can't starve the others. No more than `max_pending` images
+    are accepted across all jobs of this process; under uWSGI each worker
+    process has its own pool and limit, so the server as a whole accepts up
+    to `processes` times as many.
+    """
+
+    def __init__(self, job_dir, workers=2, max_job_images=2000, max_pending=10000,
+                 max_inflight=None, ttl=24*3600, stall_timeout=600, thumbnails=None):
+        self.job_dir = Path(job_dir)
+        self.workers = workers
+        self.max_job_images = max_job_images
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight if max_inflight is not None else 2*workers
+        self.ttl = ttl
+        self.stall_timeout = stall_timeout
+        self.thumbnails = thumbnails
+        self._pool = None
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._queues = {}
+        self._inflight = {}
+
+    def _get_pool(self):
+        # Created on first use, so that under uWSGI each worker process gets
+        # its own pool after forking.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def _path(self, job_id):
+        if not JOB_ID_RE.match(job_id):
+            raise NoSuchJob(f"No such job {job_id}")
+        path = self.job_dir / job_id
+        if not (path / "meta.json").exists():
+            raise NoSuchJob(f"No such job {job_id}")
+        return path
+
+    def create(self, uploads):
+        """Start a job scanning `uploads`, a list of werkzeug FileStorage
+        objects. Returns the job ID."""
+        n = len(uploads)
+        if n == 0:
+            raise JobError("No images given")
+        if n > self.max_job_images:
+            raise JobTooLarge(f"Too many images in one job ({n} > {self.max_job_images})")
+        self.expire()
+        with self._lock:
+            if self._pending + n > self.max_pending:
+                raise ServerBusy("Too many images waiting to be scanned, try again later")
+            self._pending += n
+
+        job_id = uuid4().hex
+        path = self.job_dir / job_id
+        queue = deque()
+        filenames = []
+        try:
+            (path / "images").mkdir(parents=True)
+            for i, upload in enumerate(uploads):
+                imgpath = path / "images" / f"{i:06d}"
+                upload.save(str(imgpath))
+                filenames.append(upload.filename)
+                queue.append((i, upload.filename, str(imgpath)))
+            (path / "results.ndjson").touch()
+            (path / "results.idx").touch()
+            with open(path / "meta.json", "w") as fh:
+                json.dump({"id": job_id, "total": n, "filenames": filenames, "created": time.time(),
+                           "owner": {"host": socket.gethostname(), "pid": os.getpid()}}, fh)
+        except Exception:
+            with self._lock:
+                self._pending -= n
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        with self._lock:
+            self._queues[job_id] = queue
+            self._inflight[job_id] = 0
+            self._submit_more(job_id)
+        return job_id
+
+    def _submit_more(self, job_id):
+        # Must be called with self._lock held
+        queue = self._queues.get(job_id)
+        if queue and not (self.job_dir / job_id / "meta.json").exists():
+            # Deleted, possibly by another server process
+            self._pending -= len(queue)
+            queue.clear()
+        while queue and self._inflight[job_id] < self.max_inflight:
+            i, filename, imgpath = queue.popleft()
+            try:
+                fut = self._get_pool().submit(_scan_job_image, imgpath, filename, self.thumbnails)
+            except BrokenProcessPool:
+                # A worker died (e.g. crashed decoding an image), so start afresh
+                self._pool = None
+                fut = self._get_pool().submit(_scan_job_image, imgpath, filename, self.thumbnails)
+            self._inflight[job_id] += 1
+            fut.add_done_callback(lambda f, j=job_id, i=i, fn=filename, p=imgpath: self._done(j, i, fn, p, f))
+
+    def _done(self, job_id, i, filename, imgpath, future):
+        path = self.job_dir / job_id
+        try:
+            result = future.result()
+        except Exception as exc:
+            if path.exists():
+                # Otherwise the job was deleted while its image was queued
+                LOG.error("Couldn't scan image '%s' in job %s", filename, job_id, exc_info=exc)
+            result = {"filename": filename, "qrcodes": None, "error": str(exc)}
+        result["index"] = i
+        with self._lock:
+            self._pending -= 1
+            self._inflight[job_id] -= 1
+            if path.exists():
+                with open(path / "results.ndjson", "ab") as fh:
+                    offset = fh.tell()
+                    fh.write((json.dumps(result) + "\n").encode("utf-8"))
+                # Written after the result, so indexed results are complete
+                with open(path / "results.idx", "ab") as fh:
+                    fh.write(struct.pack("<Q", offset))
+                Path(imgpath).unlink(missing_ok=True)
+            if self._queues.get(job_id):
+                self._submit_more(job_id)
+            if not self._queues.get(job_id) and self._inflight[job_id] == 0:
+                del self._queues[job_id]
+                del self._inflight[job_id]
+
+    def status(self, job_id, since=0):
+        """Progress of a job, and any results after the first `since`. Only
+        those results are read, so polling a large job stays cheap."""
+        path = self._path(job_id)
+        with open(path / "meta.json") as fh:
+            meta = json.load(fh)
+        # Checked before reading results, as the queue is dropped once the
+        # last result is written
+        queued = job_id in self._queues
+        with open(path / "results.idx", "rb") as fh:
+            index = fh.read()
+        done = len(index) // 8
+        since = max(0, min(since, done))
+        results = []
+        if since < done:
+            offset, = struct.unpack_from("<Q", index, since * 8)
+            with open(path / "results.ndjson", "rb") as fh:
+                fh.seek(offset)
+                for _ in range(done - since):
+                    results.append(json.loads(fh.readline()))
+        finished = done >= meta["total"]
+        error = None if finished or queued else self._abandoned(meta, path)
+        return {
+            "id": job_id,
+            "total": meta["total"],
+            "done": done,
+            "finished": finished or error is not None,
+            "failed": error is not None,
+            "error": error,
+            "results": results,
+        }
+
+    def _abandoned(self, meta, path):
+        """Why an unfinished job that this process isn't running will never
+        finish, or None if another process might still be running it."""
+        owner = meta.get("owner", {})
+        if owner.get("host") == socket.gethostname():
+            if owner.get("pid") == os.getpid():
+                # Ours, but no longer queued, e.g. after the pool was reset
+                return "The server lost this job before it finished"
+            try:
+                os.kill(owner["pid"], 0)
+            except ProcessLookupError:
+                return "The server process running this job exited before it finished"
+            except (KeyError, PermissionError):
+                pass
+        # results.ndjson is appended to as each image is done
+        if time.time() - (path / "results.ndjson").stat().st_mtime > self.stall_timeout:
+            return "This job has made no progress for too long, and has probably been lost"
+        return None
+
+    def delete(self, job_id):
+        path = self._path(job_id)
+        with self._lock:
+            queue = self._queues.get(job_id)
+            if queue:
+                self._pending -= len(queue)
+                queue.clear()
+        shutil.rmtree(path, ignore_errors=True)
+
+    def expire(self):
+        """Remove the directories of jobs older than self.ttl seconds."""
+        if not self.job_dir.exists():
+            return
+        cutoff = time.time() - self.ttl
+        for path in self.job_dir.iterdir():
+            if JOB_ID_RE.match(path.name) and path.stat().st_mtime < cutoff \
+                    and path.name not in self._queues:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,172 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from . import labelmaker
+
+from PIL import Image, ImageDraw
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Layouts that show several comma-separated fields, which get benchmark IDs
+# with three fields rather than one.
+MULTIFIELD_LAYOUTS = {"multiline_text", "multiline_text_right", "qr_multiline", "topleft_topright_bottomwrap"}
+
+
+def benchmark_ids(n, layout):
+    if layout in MULTIFIELD_LAYOUTS:
+        return (f"BENCH{i:06d},Site {i % 97},Collected by someone on day {i % 365}" for i in range(n))
+    return (f"BENCH{i:06d}" for i in range(n))
+
+
+def make_background(path):
+    """A synthetic background image, about the size of a 300dpi label."""
+    img = Image.new("RGB", (600, 200), "white")
+    draw = ImageDraw.Draw(img)
+    for x in range(0, 600, 20):
+        draw.line((x, 0, 600 - x, 200), fill=(200, 220, (x * 7) % 255), width=3)
+    img.save(path)
+    return path
+
+
+class PhaseTimer(object):
+    """Accumulates the time spent in wrapped functions, by phase."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def wrap(self, obj, attr, phase):
+        func = getattr(obj, attr)
+        self.seconds.setdefault(phase, 0.0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[phase] += time.perf_counter() - start
+        setattr(obj, attr, timed)
+
+
+def run_case(label_type, layout, n_ids, copies=1, background=None):
+    """Render one benchmark case to a temporary PDF in this process, and
+    return its measurements as a dict."""
+    timer = PhaseTimer()
+    # qr_rects and qr_path are looked up as module globals at call time, so
+    # wrapping them here times every use. qr_path calls qr_rects, so its
+    # time is mostly QR generation too.
+    timer.wrap(labelmaker, "qr_rects", "qr")
+    labeltype = labelmaker.label_types[label_type](layout=layout, background=background)
+    timer.wrap(labeltype, "fit_font", "fit")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, "labels.pdf")
+        start = time.perf_counter()
+        sheet = labelmaker.StreamingSheet(labeltype.spec, labeltype.make_label, output)
+        timer.wrap(sheet, "_flush_page", "pdf")
+        timer.wrap(sheet._canvas, "save", "pdf")
+        for obj in benchmark_ids(n_ids, layout):
+            sheet.add_label(obj, count=copies)
+        sheet.save()
+        seconds = time.perf_counter() - start
+        pdf_bytes = os.path.getsize(output)
+    phases = {f"{k}_seconds": round(v, 4) for k, v in timer.seconds.items()}
+    phases["layout_seconds"] = round(seconds - sum(timer.seconds.values()), 4)
+    n_labels = n_ids * copies
+    return {
+        "label_type": label_type,
+        "layout": layout,
+        "n_ids": n_ids,
+        "copies": copies,
+        "background": background is not None,
+        "labels": n_labels,
+        "pages": sheet.page_count,
+        "seconds": round(seconds, 4),
+        "labels_per_sec": round(n_labels / seconds, 1),
+        "pdf_bytes": pdf_bytes,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        **phases,
+    }
+
+
+def run_case_subprocess(case):
+    """Run a case in a fresh interpreter, so that its peak RSS is its own."""
+    cmd = [sys.executable, "-m", "qrmagic.labelbench", "--run-case", json.dumps(case)]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"
+        return dict(case, background=case["background"] is not None, error=error)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="qrmagic-labelbench",
+            description="Benchmark label rendering over label types and layouts. Writes one JSON record per case.")
+    ap.add_argument("--label-type", "-l", action="append", choices=list(labelmaker.label_types),
+            help="Only benchmark this label type (may be given more than once; default all).")
+    ap.add_argument("--layout", action="append",
+            help="Only benchmark this layout (may be given more than once; default all of each type's layouts).")
+    ap.add_argument("--sizes", default="100,10000",
+            help="Comma-separated numbers of IDs to render, e.g. 100,10000,100000 (default 100,10000).")
+    ap.add_argument("--copies", default="1,4",
+            help="Comma-separated numbers of copies of each label (default 1,4).")
+    ap.add_argument("--background", choices=["none", "synthetic", "both"], default="both",
+            help="Render without a background image, with a synthetic one, or both (default both).")
+    ap.add_argument("--output", "-o", type=argparse.FileType("a"), default=sys.stdout,
+            help="Append JSON-lines results to this file (default stdout).")
+    ap.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run_case:
+        # Keep labelmaker's warnings out of the result
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run_case(**json.loads(args.run_case))
+        print(json.dumps(result))
+        return
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    copies = [int(x) for x in args.copies.split(",")]
+    commit = git_commit()
+    version = getattr(sys.modules["qrmagic"], "__version__", None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        backgrounds = []
+        if args.background in ("none", "both"):
+            backgrounds.append(None)
+        if args.background in ("synthetic", "both"):
+            backgrounds.append(make_background(os.path.join(tmpdir, "background.png")))
+        for label_type in args.label_type or labelmaker.label_types:
+            for layout in labelmaker.label_types[label_type].layouts:
+                if args.layout and layout not in args.layout:
+                    continue
+                for n_ids in sizes:
+                    for n_copies in copies:
+                        for background in backgrounds:
+                            case = {"label_type": label_type, "layout": layout, "n_ids": n_ids,
+                                    "copies": n_copies, "background": background}
+                            result = run_case_subprocess(case)
+                            result.update(commit=commit, version=version, python=platform.python_version())
+                            print(json.dumps(result), file=args.output, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from .diskcache import evict_lru
+
+
+KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+class LabelCache(object):
+    """Size-bounded on-disk cache of rendered label PDFs.
+
+    PDFs are named by a hash of the normalised request that produced them, so
+    identical requests map to the same file. Each hit touches the file's
+    mtime, and once the cache holds more than `max_bytes` the least recently
+    used files are deleted. Any process sharing the cache may delete a file
+    at any time, so PDFs are handed out as open files, which stay readable
+    after they are deleted.
+    """
+    # Bump whenever label rendering changes, so old PDFs aren't served
+    RENDER_VERSION = 2
+
+    def __init__(self, path, max_bytes=512<<20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, request):
+        """Cache key for a normalised label request (a JSON-able dict)."""
+        request = dict(request, render_version=self.RENDER_VERSION)
+        blob = json.dumps(request, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+    def filename(self, key):
+        if not KEY_RE.match(key):
+            raise KeyError(key)
+        return os.path.join(self.path, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        """The cached PDF for `key`, opened for reading, or None on a miss."""
+        try:
+            fh = open(self.filename(key), "rb")
+        except (KeyError, OSError):
+            return None
+        try:
+            os.utime(fh.fileno())
+        except OSError:
+            pass
+        return fh
+
+    def put(self, key, render):
+        """Call render(fh) to write the PDF for `key` to a temporary file,
+        then add it to the cache. Returns the cached PDF, opened for reading."""
+        path = self.filename(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                render(fh)
+            result = open(tmp, "rb")
+            # Rename into place, so other processes never see a partial PDF
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict(keep=path)
+        return result
+
+    def evict(self, keep=None):
+        """Delete least recently used PDFs until the cache fits in max_bytes."""
+        evict_lru(self.path, self.max_bytes, keep=keep)
@@ -6,36 +6,494 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from labels import Specification, Sheet
-from reportlab.graphics import shapes
+from reportlab.graphics import shapes, renderPDF
+from reportlab import rl_config
 from reportlab.lib import colors
+from reportlab.lib.attrmap import AttrMap, AttrMapValue
+from reportlab.lib.validators import isString, isInt
 from reportlab.lib.units import mm, inch
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase.pdfmetrics import getFont, stringWidth
+from reportlab.pdfgen.canvas import Canvas
+from pypdf import PdfReader, PdfWriter
 import qrcode
 from tqdm import tqdm
 from PIL import Image
 
 import argparse
+import functools
+import hashlib
+import multiprocessing as mp
 import sys
 import textwrap
 import json
+from collections import deque
+from io import BytesIO
 
 
 __all__ = [
         "label_types",
         "generate_labels",
+        "generate_labels_parallel",
         "main",
 ]
 
+# PDF streams are Flate compressed either way. ASCII85 on top only makes
+# them a quarter larger, to keep the PDF 7-bit clean, which nothing needs.
+rl_config.useA85 = 0
+
+QR_ERROR_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def qr_rects(data, error_level="H"):
+    """The dark modules of a QR code for `data`, as few-ish rectangles.
+
+    Each horizontal run of dark modules is a rectangle, and runs with the same
+    extent in consecutive rows are merged. Returns (n, rects), where n is the
+    number of modules per side and rects is a tuple of (x, y, width, height)
+    in module units, with the origin at the bottom left.
+    """
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=QR_ERROR_LEVELS[error_level],
+        border=0
+    )
+    qr.add_data(str(data))
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    n = len(matrix)
+    rects = []
+    open_rects = {}  # (x, width) -> index in rects of a rect ending at the previous row
+    for row, modules in enumerate(matrix):
+        y = n - row - 1
+        row_rects = {}
+        col = 0
+        while col < n:
+            if not modules[col]:
+                col += 1
+                continue
+            start = col
+            while col < n and modules[col]:
+                col += 1
+            key = (start, col - start)
+            if key in open_rects:
+                # Extend the rect from the row above down by one module
+                i = open_rects[key]
+                x, _, w, h = rects[i]
+                rects[i] = (x, y, w, h + 1)
+            else:
+                i = len(rects)
+                rects.append((start, y, col - start, 1))
+            row_rects[key] = i
+        open_rects = row_rects
+    return n, tuple(rects)
+
+
+@functools.lru_cache(maxsize=1024)
+def qr_path(data, error_level="H"):
+    """qr_rects() as a reportlab Path."""
+    n, rects = qr_rects(data, error_level)
+    path = shapes.Path(fillColor=colors.black, strokeColor=None, strokeWidth=0)
+    for x, y, w, h in rects:
+        path.moveTo(x, y)
+        path.lineTo(x + w, y)
+        path.lineTo(x + w, y + h)
+        path.lineTo(x, y + h)
+        path.closePath()
+    return path
+
+
+class QRCodeNode(shapes.Group):
+    """A QR code drawn in module units.
+
+    When rendered to PDF, the code's rectangles are written straight into
+    the page stream as integer module coordinates. Codes on a page share
+    most of their structure, and copies are identical, so they compress to
+    far less than a raster or a form XObject per code. Other renderers draw
+    it as a Path.
+    """
+    _attrMap = AttrMap(BASE=shapes.Group,
+        data=AttrMapValue(isString, desc="QR code contents"),
+        error_level=AttrMapValue(isString, desc="QR error correction level (L, M, Q or H)"),
+        n=AttrMapValue(isInt, desc="Modules per side"),
+    )
+
+    def __init__(self, data, error_level="H"):
+        shapes.Group.__init__(self)
+        self.data = data
+        self.error_level = error_level
+        self.n, _ = qr_rects(data, error_level)
+
+    def _drawTimeCallback(self, node, canvas=None, renderer=None):
+        if not isinstance(canvas, Canvas):
+            self.contents = [qr_path(self.data, self.error_level)]
+            return
+        self.contents = []
+        _, rects = qr_rects(self.data, self.error_level)
+        # Kept within q/Q, so the fill colour doesn't leak into the
+        # renderer's idea of the current state
+        canvas.saveState()
+        canvas.setFillColor(colors.black)
+        path = canvas.beginPath()
+        for x, y, w, h in rects:
+            path.rect(x, y, w, h)
+        canvas.drawPath(path, stroke=0, fill=1)
+        canvas.restoreState()
+
+
+class BackgroundNode(shapes.Group):
+    """A label background image, drawn at 0, 0 with the given size.
+
+    When rendered to PDF, the image is written once as a form XObject named
+    `name`, which every label then references. Other renderers draw it as an
+    ordinary Image.
+    """
+    _attrMap = AttrMap(BASE=shapes.Group,
+        name=AttrMapValue(isString, desc="Form XObject name"),
+    )
+
+    def __init__(self, name, image, width, height):
+        shapes.Group.__init__(self)
+        self.name = name
+        self._image = image
+        self._size = (width, height)
+
+    def _drawTimeCallback(self, node, canvas=None, renderer=None):
+        width, height = self._size
+        if not hasattr(canvas, "doForm"):
+            self.contents = [shapes.Image(0, 0, width, height, self._image)]
+            return
+        self.contents = []
+        if not canvas.hasForm(self.name):
+            canvas.beginForm(self.name, 0, 0, width, height)
+            canvas.drawImage(ImageReader(self._image), 0, 0, width, height)
+            canvas.endForm()
+        canvas.doForm(self.name)
+
+
+class FontMetrics(object):
+    """Cached metrics for one font, in 1/1000ths of the font size.
+
+    Text width and height are both proportional to font size, so the
+    largest integer size at which a string fits a box can be computed
+    directly rather than by trying each size in turn.
+    """
+
+    def __init__(self, font_name):
+        self.font_name = font_name
+        face = getFont(font_name).face
+        self.ascent = face.ascent
+        self.descent = face.descent
+        self._char_widths = {}
+
+    def height(self, font_size):
+        return ((self.ascent*font_size) - (self.descent*font_size)) / 1000
+
+    def width(self, text, font_size):
+        return stringWidth(text, self.font_name, font_size)
+
+    def text_units(self, text):
+        """Width of `text` at font size 1000."""
+        widths = self._char_widths
+        try:
+            return sum(map(widths.__getitem__, text))
+        except KeyError:
+            for char in set(text) - widths.keys():
+                widths[char] = stringWidth(char, self.font_name, 1000)
+            return sum(map(widths.__getitem__, text))
+
+    def fit(self, text, max_size, available_width, available_height, min_size=3):
+        """Largest integer font size from max_size down to min_size at which
+        `text` fits in the available space.
+
+        Returns (font_size, text width, text height, fitted). If nothing fits,
+        the metrics of min_size are returned with fitted=False.
+        """
+        units = self.text_units(text)
+        size = max_size
+        if self.height(1000) > 0:
+            size = min(size, int(available_height * 1000 / self.height(1000)))
+        if units > 0:
+            size = min(size, int(available_width * 1000 / units))
+        # Rounding can put the estimate out by one either way, so check it
+        # against stringWidth() itself, which gives the widths we return.
+        while size >= min_size:
+            width = self.width(text, size)
+            if width <= available_width and self.height(size) <= available_height:
+                break
+            size -= 1
+        else:
+            return min_size, self.width(text, min_size), self.height(min_size), False
+        bigger = size + 1
+        if bigger <= max_size and self.height(bigger) <= available_height \
+                and units * bigger / 1000 <= available_width * (1 + 1e-9):
+            bigger_width = self.width(text, bigger)
+            if bigger_width <= available_width:
+                size, width = bigger, bigger_width
+        return size, width, self.height(size), True
+
+
+@functools.lru_cache(maxsize=None)
+def font_metrics(font_name):
+    return FontMetrics(font_name)
+
+
+class LayoutPlan(object):
+    """The geometry of one label layout for a given LabelSpec and label size.
+
+    Everything that doesn't depend on the label's text is worked out once in
+    setup(), so that draw() only has to fit the text and place the QR code.
+    New layouts subclass this and are added to LabelSpec.layout_plans.
+    """
+
+    def __init__(self, spec, width, height):
+        self.spec = spec
+        self.width = width
+        self.height = height
+        self.hm = spec.hmargin          # horizontal margin
+        self.vm = spec.vmargin          # vertical margin
+        self.hg = spec.hgap             # inter-element gap
+        self.ht = (height - 2*self.vm)  # Usable height
+        self.wd = (width - 2*self.hm)   # Usable width
+        self.qs = spec.qrsize           # QRcode size
+        if self.qs > self.ht:
+            print(f"Scaling down QR size ({self.qs/mm:0.1f}mm) to available height ({self.ht/mm:0.1f}mm)")
+            self.qs = self.ht
+        assert self.ht <= height
+        self.setup()
+
+    def setup(self):
+        pass
+
+    def draw(self, label, obj, text, lines):
+        raise NotImplementedError
+
+    def string(self, x, y, text, font_size):
+        return shapes.String(x, y, text, fontName=self.spec.font_name, fontSize=font_size)
+
+    def vertical_string(self, x, y, text, font_size):
+        group = shapes.Group()
+        group.add(self.string(x, y, text, font_size))
+        group.rotate(90)
+        return group
+
+
+class QRLeftPlan(LayoutPlan):
+    texttop = False
+
+    def setup(self):
+        self.qleft = self.hm
+        if self.texttop:
+            self.qbottom = self.vm + (self.ht - self.qs)
+        else:
+            self.qbottom = self.vm + (self.ht - self.qs) / 2
+        self.tleft = self.qleft + self.qs + self.hg
+        self.tavail = self.wd - self.tleft
+
+    def draw(self, label, obj, text, lines):
+        label.add(self.spec.qrshape(obj, self.qleft, self.qbottom, self.qs))
+        fsz, tw, th, fitted = self.spec.fit_font(text, self.tavail, self.ht)
+        if self.texttop:
+            tbottom = self.height - self.vm - th*1.1
+        else:
+            tbottom = self.vm + (self.ht - th)/2
+        label.add(self.string(self.tleft, tbottom, text, fsz))
+
+
+class QRLeftTextTopPlan(QRLeftPlan):
+    texttop = True
+
+
+class QRRightPlan(LayoutPlan):
+    texttop = False
+
+    def setup(self):
+        self.qleft = self.width - self.qs - self.hm
+        self.qbottom = self.vm + (self.ht - self.qs) / 2
+        self.tright = self.qleft - self.hg
+        self.tavail = self.tright - self.hm
+
+    def draw(self, label, obj, text, lines):
+        label.add(self.spec.qrshape(obj, self.qleft, self.qbottom, self.qs))
+        fsz, tw, th, fitted = self.spec.fit_font(text, self.tavail, self.ht)
+        tleft = self.tright - tw
+        if self.texttop:
+            tbottom = self.ht - self.vm - th
+        else:
+            tbottom = self.vm + (self.ht - th)/2
+        label.add(self.string(tleft, tbottom, text, fsz))
+
+
+class QRRightTextTopPlan(QRRightPlan):
+    texttop = True
+
+
+class TopHalfPlan(LayoutPlan):
+    def setup(self):
+        self.qs = self.qs/2
+        self.ht = self.ht/2
+        self.qleft = self.width - self.qs - self.hm
+        self.qbottom = self.vm + self.ht + (self.ht - self.qs) / 2
+        self.tright = self.qleft - self.hg
+        self.tavail = self.tright - self.hm
+
+    def draw(self, label, obj, text, lines):
+        fsz, tw, th, fitted = self.spec.fit_font(text, self.tavail, self.ht)
+        tleft = self.tright - tw
+        tbottom = self.vm + self.ht + (self.ht - th)/2
+        # Centre the QR code and text together
+        hspace = self.width - (self.hm + tw + self.hg + self.qs + self.hm)
+        qleft = self.qleft - hspace/2
+        tleft -= hspace/2
+        label.add(self.spec.qrshape(obj, qleft, self.qbottom, self.qs))
+        label.add(self.string(tleft, tbottom, text, fsz))
+
+
+class QRTopPlan(LayoutPlan):
+    def setup(self):
+        self.qleft = self.hm + (self.wd - self.qs)/2
+        self.qbottom = self.height - self.vm - self.qs
+        self.twavail = self.wd
+        self.thavail = self.qbottom - 2*self.vm
+
+    def draw(self, label, obj, text, lines):
+        label.add(self.spec.qrshape(obj, self.qleft, self.qbottom, self.qs))
+        fsz, tw, th, fitted = self.spec.fit_font(text, self.twavail, self.thavail)
+        tbottom = self.vm + (self.qbottom -2*self.vm - th)/2
+        tleft = self.hm + (self.wd-tw)/2
+        label.add(self.string(tleft, tbottom, text, fsz))
+
+
+class QRLeftVerticalTextPlan(LayoutPlan):
+    def setup(self):
+        self.qleft = self.hm
+        self.qbottom = self.vm + (self.ht - self.qs) / 2
+        self.twavail = self.height - 2*self.vm
+        self.thavail = self.width - 3*self.hm - self.qs
+        self.tleft = self.qleft + self.qs + self.hm
+
+    def draw(self, label, obj, text, lines):
+        label.add(self.spec.qrshape(obj, self.qleft, self.qbottom, self.qs))
+        fsz, tw, th, fitted = self.spec.fit_font(text, self.twavail, self.thavail)
+        tbottom = self.vm + (self.twavail - tw)/2
+        label.add(self.vertical_string(tbottom, -(self.tleft + th), text, fsz))
+
+
+class QRRightVerticalTextPlan(LayoutPlan):
+    def setup(self):
+        self.twavail = self.height - 2*self.vm
+        self.thavail = self.width - 2*self.hm - self.hg - self.qs
+        self.tleft = self.hm
+        self.qbottom = self.vm + (self.ht - self.qs) / 2
+
+    def draw(self, label, obj, text, lines):
+        fsz, tw, th, fitted = self.spec.fit_font(text, self.twavail, self.thavail)
+        tbottom = self.vm + (self.twavail - tw)/2
+        label.add(self.vertical_string(tbottom, -(self.tleft + th), text, fsz))
+        qleft = self.tleft + th + self.hm
+        label.add(self.spec.qrshape(obj, qleft, self.qbottom, self.qs))
+
+
+class MultilineTextPlan(LayoutPlan):
+    align_right = False
+
+    def setup(self):
+        self.tavail = self.wd - self.hm
+
+    def draw(self, label, obj, text, lines):
+        n_lines = len(lines)
+        longest_line = max(lines, key=lambda s: len(s))
+        fsz, tw, th, fitted = self.spec.fit_font(longest_line, self.tavail, self.ht/n_lines)
+        tbottom = self.vm + (self.ht - th*n_lines)/2
+        for i, line in enumerate(reversed(lines)):
+            if self.align_right:
+                tw = stringWidth(line, self.spec.font_name, fsz)
+                tleft = self.wd - tw
+            else:
+                tleft = self.hm
+            label.add(self.string(tleft, tbottom + i * th, line, fsz))
+
+
+class MultilineTextRightPlan(MultilineTextPlan):
+    align_right = True
+
+
+class TopLeftTopRightBottomWrapPlan(LayoutPlan):
+    def setup(self):
+        self.tavail = self.wd - 2*self.hm
+        self.top_theight = (self.height - 3*self.vm) / 3
+        self.rest_vavail = self.height - self.top_theight - 2* self.vm
+
+    def draw(self, label, obj, text, lines):
+        hm, vm, tavail = self.hm, self.vm, self.tavail
+        text_topleft, text_topright = lines[:2]
+        (lfsz, ltw, lth, _), (fsz, tw, th, _) = self.spec.fit_fonts([text_topleft, text_topright], tavail/2, self.top_theight)
+        label.add(self.string(hm, self.height - (vm+lth), text_topleft, lfsz))
+        label.add(self.string(self.width - hm - tw, self.height - (vm +th), text_topright, fsz))
+
+        if len(lines[2]) < 1:
+            return
+        for n_lines in range(1, 6):
+            text_rest = textwrap.wrap(lines[2], int(len(lines[2])/n_lines))
+            longest_line = max(text_rest, key=lambda x: len(x))
+            fsz, tw, th, fitted = self.spec.fit_font(longest_line, tavail, self.rest_vavail/len(text_rest))
+            if fitted and fsz >= self.spec.font_size*0.5:
+                break
+        for i, line in enumerate(reversed(text_rest)):
+            label.add(self.string(hm, vm + i * th, line, fsz))
+
+
+class QRMultilinePlan(LayoutPlan):
+    def setup(self):
+        self.qleft = self.hm
+        self.qbottom = self.vm + (self.ht - self.qs) / 2
+        self.tleft = self.qleft + self.qs + self.hg
+        self.tavail = self.wd - self.tleft
+
+    def draw(self, label, obj, text, lines):
+        label.add(self.spec.qrshape(lines[0], self.qleft, self.qbottom, self.qs))
+        n_lines = len(lines)
+        longest_line = max(lines, key=lambda s: len(s))
+        fsz, tw, th, fitted = self.spec.fit_font(longest_line, self.tavail, self.ht/n_lines)
+        tbottom = self.vm + (self.ht - th*n_lines)
+        for i, line in enumerate(reversed(lines)):
+            label.add(self.string(self.tleft, tbottom + i * th, line, fsz))
+
+
 class LabelSpec(object):
     hmargin = 1.5*mm
     hgap = 1*mm
     vmargin = 1.2*mm
     default_layout = "qr_left"
+    qr_error = "H"
+    background_dpi = 300
     layouts = ["qr_left", "qr_left_texttop",  "qr_right", "multiline_text", "multiline_text_right", "top_half", "qr_multiline", "topleft_topright_bottomwrap"]
+    layout_plans = {
+        "qr_left": QRLeftPlan,
+        "qr_left_texttop": QRLeftTextTopPlan,
+        "qr_right": QRRightPlan,
+        "qr_right_texttop": QRRightTextTopPlan,
+        "top_half": TopHalfPlan,
+        "qr_top": QRTopPlan,
+        "qr_left_verticaltext": QRLeftVerticalTextPlan,
+        "qr_right_verticaltext": QRRightVerticalTextPlan,
+        "multiline_text": MultilineTextPlan,
+        "multiline_text_right": MultilineTextRightPlan,
+        "topleft_topright_bottomwrap": TopLeftTopRightBottomWrapPlan,
+        "qr_multiline": QRMultilinePlan,
+    }
 
     def __init__(self, layout=None, qrsize=None, line_delim=",", background=None, font_size=None, vmargin=None, hmargin=None):
         self.spec = Specification(**self.page)
         self.background = background
+        self._background_cache = {}
+        self._plans = {}
         if font_size is not None:
             self.font_size = font_size
         if layout is None:
@@ -62,172 +520,67 @@ class LabelSpec(object):
         qr.make(fit=True)
         return qr.make_image(fill_color="black", back_color="white")
 
+    def qrshape(self, data, x, y, size):
+        """A size x size vector QR code for `data` with its bottom left corner at (x, y)."""
+        qr = QRCodeNode(str(data), self.qr_error)
+        return shapes.Group(qr, transform=(size/qr.n, 0, 0, size/qr.n, x, y))
+
+    def background_shape(self, width, height):
+        """The background image for a width x height label, as a shape. The
+        image is decoded once, and only scaled down to background_dpi at
+        the size it is drawn."""
+        bg = self._background_cache.get((width, height))
+        if bg is None:
+            with open(self.background, "rb") as fh:
+                data = fh.read()
+            bgim = Image.open(BytesIO(data))
+            bgim.load()
+            imwidth = int(round(max(height / bgim.height  * bgim.width, width)))
+            px = (int(imwidth / inch * self.background_dpi), int(height / inch * self.background_dpi))
+            if px[0] < bgim.width and px[1] < bgim.height:
+                bgim = bgim.resize(px, Image.LANCZOS)
+            key = f"{imwidth}x{height}@{self.background_dpi}".encode("utf-8")
+            name = "bg" + hashlib.sha1(data + key).hexdigest()[:16]
+            bg = self._background_cache[(width, height)] = (name, bgim, imwidth)
+        name, bgim, imwidth = bg
+        return BackgroundNode(name, bgim, imwidth, height)
+
     def fit_font(self, text, available_width, available_height):
-        for font_size in range(self.font_size, 2, -1):
-            twidth = stringWidth(text, self.font_name, font_size)
-            fnt = getFont(self.font_name).face
-            textheight = (((fnt.ascent*font_size) -
-                           (fnt.descent*font_size)) / 1000)
-            if twidth > available_width or textheight > available_height:
-                #print(font_size, "too high")
-                continue
-            return font_size, twidth, textheight, True
-        print("WARNING: couldn't fit", str(text), "into", f"{available_width / mm:0.1f}", "mm space availabe")
-        return font_size, twidth, textheight, False
+        font_size, twidth, textheight, fitted = font_metrics(self.font_name).fit(
+                text, self.font_size, available_width, available_height)
+        if not fitted:
+            print("WARNING: couldn't fit", str(text), "into", f"{available_width / mm:0.1f}", "mm space availabe")
+        return font_size, twidth, textheight, fitted
+
+    def fit_fonts(self, texts, available_width, available_height):
+        """fit_font() for many strings at once. The available width and height
+        may each be a single value or a sequence with one value per string."""
+        n = len(texts)
+        if not hasattr(available_width, "__len__"):
+            available_width = [available_width] * n
+        if not hasattr(available_height, "__len__"):
+            available_height = [available_height] * n
+        return [self.fit_font(text, aw, ah)
+                for text, aw, ah in zip(texts, available_width, available_height)]
+
+    def layout_plan(self, width, height):
+        """The compiled LayoutPlan of this spec's layout for a width x height label."""
+        plan = self._plans.get((width, height))
+        if plan is None:
+            plan = self._plans[(width, height)] = self.layout_plans[self.layout](self, width, height)
+        return plan
 
     def make_label(self, label, width, height, obj, *args, **kwargs):
         text = str(obj)
         if text == "" or text == ".":
             return
-        hm = self.hmargin       # horizontal margin
-        vm = self.vmargin       # vertical margin
-        hg = self.hgap          # inter-element gap
-        ht = (height - 2*vm)    # Usable height
-        wd = (width - 2*hm)     # Usable width
-        qs = self.qrsize        # QRcode size
-        if qs > ht:
-            print(f"Scaling down QR size ({qs/mm:0.1f}mm) to available height ({ht/mm:0.1f}mm)")
-            qs = ht
-        assert ht <= height
-
+        plan = self.layout_plan(width, height)
         lines = list(text.rstrip().split(self.line_delim))
-        longest_line = max(lines, key=lambda s: len(s))
-        n_lines = len(lines)
-
         if self.background is not None:
-            bgim = Image.open(self.background)
-            imwidth = int(round(max(height / bgim.height  * bgim.width, width)))
-            label.add(shapes.Image(0, 0, imwidth, height, bgim))
-        if self.layout in ("qr_left", "qr_left_texttop"):
-            qleft = hm
-            if self.layout == "qr_left":
-                qbottom = vm + (ht - qs) / 2
-            else:
-                qbottom = vm + (ht - qs)
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(obj)))
-            tleft = qleft + qs + hg
-            tavail = wd - tleft
-            fsz, tw, th, fitted = self.fit_font(text, tavail, ht)
-            if self.layout == "qr_left":
-                tbottom = vm + (ht - th)/2
-            else:
-                tbottom = height - vm - th*1.1
-            label.add(shapes.String(tleft, tbottom, text, fontName=self.font_name, fontSize=fsz))
-
-        elif self.layout in ("qr_right", "qr_right_texttop"):
-            qleft = width - qs - hm
-            qbottom = vm + (ht - qs) / 2
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(obj)))
-            tright = qleft - hg
-            tavail = tright - hm
-            fsz, tw, th, fitted = self.fit_font(text, tavail, ht)
-            tleft = tright - tw
-            if self.layout == "qr_right":
-                tbottom = vm + (ht - th)/2
-            else:
-                tbottom = ht - vm - th
-            label.add(shapes.String(tleft, tbottom, text, fontName=self.font_name, fontSize=fsz))
-
-        elif self.layout == "top_half":
-            qs = qs/2
-            ht = ht/2
-            qleft = width - qs - hm
-            qbottom = vm + ht + (ht - qs) / 2
-            tright = qleft - hg
-            tavail = tright - hm
-            fsz, tw, th, fitted = self.fit_font(text, tavail, ht)
-            tleft = tright - tw
-            tbottom = vm + ht + (ht - th)/2
-            hspace = width - (hm + tw + hg + qs + hm)
-            qleft -= hspace/2
-            tleft -= hspace/2
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(obj)))
-            label.add(shapes.String(tleft, tbottom, text, fontName=self.font_name, fontSize=fsz))
-
-        elif self.layout == "qr_top":
-            qleft = hm + (wd - qs)/2
-            qbottom = height - vm - qs
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(obj)))
-            twavail = wd
-            thavail = qbottom - 2*vm
-            fsz, tw, th, fitted = self.fit_font(text, twavail, thavail)
-            tbottom = vm + (qbottom -2*vm - th)/2
-            tleft = hm + (wd-tw)/2
-            label.add(shapes.String(tleft, tbottom, text, fontName=self.font_name, fontSize=fsz))
-
-        elif self.layout == "qr_left_verticaltext":
-            qleft = hm
-            qbottom = vm + (ht - qs) / 2
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(obj)))
-            twavail = height - 2*vm
-            thavail = width - 3*hm - qs
-            fsz, tw, th, fitted = self.fit_font(text, twavail, thavail)
-            tbottom = vm + (twavail - tw)/2
-            tleft = qleft + qs + hm
-            group = shapes.Group()
-            group.add(shapes.String(tbottom, -(tleft + th), text, fontName=self.font_name, fontSize=fsz))
-            group.rotate(90)
-            label.add(group)
-
-        elif self.layout == "qr_right_verticaltext":
-            twavail = height - 2*vm
-            thavail = width - 2*hm - hg - qs
-            fsz, tw, th, fitted = self.fit_font(text, twavail, thavail)
-            tbottom = vm + (twavail - tw)/2
-            tleft = hm
-            group = shapes.Group()
-            group.add(shapes.String(tbottom, -(tleft + th), text, fontName=self.font_name, fontSize=fsz))
-            group.rotate(90)
-            label.add(group)
-            qleft = tleft + th + hm
-            qbottom = vm + (ht - qs) / 2
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(obj)))
-
-        elif self.layout.startswith("multiline_text"):
-            tavail = wd - hm
-            fsz, tw, th, fitted = self.fit_font(longest_line, tavail, ht/n_lines)
-            tbottom = vm + (ht - th*n_lines)/2
-            for i, line in enumerate(reversed(lines)):
-                if self.layout == "multiline_text":
-                    tleft = hm
-                else:
-                    tw = stringWidth(line, self.font_name, fsz)
-                    tleft = wd - tw
-                label.add(shapes.String(tleft, tbottom + i * th, line, fontName=self.font_name, fontSize=fsz))
-
-        elif self.layout == "topleft_topright_bottomwrap":
-            tavail = wd - 2*hm
-            text_topleft, text_topright = lines[:2]
-            top_theight = (height - 3*vm) / 3
-            fsz, tw, th, fitted = self.fit_font(text_topleft, tavail/2, top_theight)
-            label.add(shapes.String(hm, height - (vm+th), text_topleft, fontName=self.font_name, fontSize=fsz))
-            fsz, tw, th, fitted = self.fit_font(text_topright, tavail/2, top_theight)
-            label.add(shapes.String(width - hm - tw, height - (vm +th), text_topright, fontName=self.font_name, fontSize=fsz))
-
-            rest_vavail = height - top_theight - 2* vm
-            if len(lines[2]) < 1:
-                return
-            for n_lines in range(1, 6):
-                text_rest = textwrap.wrap(lines[2], int(len(lines[2])/n_lines))
-                longest_line = max(text_rest, key=lambda x: len(x))
-                fsz, tw, th, fitted = self.fit_font(longest_line, tavail, rest_vavail/len(text_rest))
-                if fitted and fsz >= self.font_size*0.5:
-                    break
-            for i, line in enumerate(reversed(text_rest)):
-                label.add(shapes.String(hm, vm + i * th, line, fontName=self.font_name, fontSize=fsz))
-
-        elif self.layout == "qr_multiline":
-            qleft = hm
-            qbottom = vm + (ht - qs) / 2
-            label.add(shapes.Image(qleft, qbottom, qs, qs, self.qrimg(lines[0])))
-
-            tleft = qleft + qs + hg
-            tavail = wd - tleft
-            fsz, tw, th, fitted = self.fit_font(longest_line, tavail, ht/n_lines)
-            tbottom = vm + (ht - th*n_lines)
-            for i, line in enumerate(reversed(lines)):
-                label.add(shapes.String(tleft, tbottom + i * th, line, fontName=self.font_name, fontSize=fsz))
-    
+            label.add(self.background_shape(width, height))
+        plan.draw(label, obj, text, lines)
+
+
 class AddressLabels(LabelSpec):
     description = "12 sheets, each label is a vertical third of A6 (2x6)"
     font_name = "Helvetica"
@@ -502,12 +855,117 @@ for lt in label_types:
         }
 
 
-def generate_labels(labeltype, text_source, copies=1, border=False, background=None):
-    sheet = Sheet(labeltype.spec, labeltype.make_label, border=border)
+class StreamingSheet(Sheet):
+    """A pylabels Sheet that draws each page onto the output PDF as soon as it
+    is full, and then drops it, so only one page of drawings is ever held in
+    memory. save() finishes the PDF; there are no pages left to preview."""
+
+    def __init__(self, specification, drawing_callable, output, **kwargs):
+        Sheet.__init__(self, specification, drawing_callable, **kwargs)
+        self._canvas = Canvas(output, pagesize=self._pagesize)
+
+    def _flush_page(self):
+        if self._current_page is not None:
+            renderPDF.draw(self._current_page, self._canvas, 0, 0)
+            self._canvas.showPage()
+            self._current_page = None
+        self._pages = []
+
+    def _new_page(self):
+        self._flush_page()
+        Sheet._new_page(self)
+
+    def save(self, filelike=None):
+        self._shade_remaining_missing()
+        self._flush_page()
+        self._canvas.save()
+
+
+def generate_labels(labeltype, text_source, copies=1, border=False, background=None, output=None):
+    """Lay out a label for each item of `text_source`. If `output` (a path or
+    binary file) is given, pages are written to it as they fill up, and the
+    PDF is complete on return. Otherwise, call .save() on the returned sheet."""
+    if output is not None:
+        sheet = StreamingSheet(labeltype.spec, labeltype.make_label, output, border=border)
+    else:
+        sheet = Sheet(labeltype.spec, labeltype.make_label, border=border)
     for obj in tqdm(text_source):
         sheet.add_label(obj, count=copies)
+    if output is not None:
+        sheet.save()
     return sheet 
 
+
+def page_chunks(text_source, labels_per_page, copies=1, pages_per_chunk=1):
+    """Split labels into chunks filling `pages_per_chunk` whole pages each.
+
+    Yields lists of (obj, count) pairs. Where the copies of one label run over
+    a chunk boundary, that label is split between the two chunks, so rendering
+    each chunk as its own sheet gives the same pages as a single sheet would.
+    """
+    per_chunk = labels_per_page * pages_per_chunk
+    chunk = []
+    used = 0
+    for obj in text_source:
+        left = copies
+        while left > 0:
+            count = min(left, per_chunk - used)
+            chunk.append((obj, count))
+            used += count
+            left -= count
+            if used == per_chunk:
+                yield chunk
+                chunk = []
+                used = 0
+    if chunk:
+        yield chunk
+
+
+def _init_worker(labeltype, border):
+    # Sent once per worker rather than with every chunk
+    global _worker_labeltype, _worker_border
+    _worker_labeltype = labeltype
+    _worker_border = border
+
+
+def _render_chunk(chunk):
+    labeltype = _worker_labeltype
+    sheet = Sheet(labeltype.spec, labeltype.make_label, border=_worker_border)
+    for obj, count in chunk:
+        sheet.add_label(obj, count=count)
+    pdf = BytesIO()
+    sheet.save(pdf)
+    return pdf.getvalue()
+
+
+def generate_labels_parallel(labeltype, text_source, output, copies=1, border=False, threads=None, pages_per_chunk=4):
+    """Like generate_labels(), but render chunks of whole pages on `threads`
+    processes and write the joined PDF to `output` (a path or binary file).
+
+    Fonts, images and QR codes that end up identical in several chunks are
+    only written to the output once. Only `2*threads` chunks are queued or
+    waiting to be joined at once, so `text_source` is read as chunks are
+    rendered.
+    """
+    if threads is None:
+        threads = mp.cpu_count()
+    labels_per_page = labeltype.spec.rows * labeltype.spec.columns
+    chunks = page_chunks(text_source, labels_per_page, copies, pages_per_chunk)
+    writer = PdfWriter()
+    with mp.Pool(threads, initializer=_init_worker, initargs=(labeltype, border)) as pool, \
+            tqdm(unit="chunk") as progress:
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= 2*threads:
+                writer.append(PdfReader(BytesIO(pending.popleft().get())))
+                progress.update()
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+        while pending:
+            writer.append(PdfReader(BytesIO(pending.popleft().get())))
+            progress.update()
+    writer.compress_identical_objects()
+    writer.write(output)
+
 def main():
     morehelp  = """
 There are four modes of operation: two for your assistance, and two actually functional modes
@@ -560,6 +1018,10 @@ To actually do anything, you need one of the following:
             help="PNG image to set as each label's background. With this you can make any complicated designs you wish.")
     ap.add_argument("--font-size", default=None, type=int,
             help="Override font size to be X.")
+    ap.add_argument("--threads", "-t", type=int, default=1, metavar="N",
+            help="Render pages on N processes (default 1).")
+    ap.add_argument("--pages-per-chunk", type=int, default=4, metavar="N",
+            help="With --threads, render N pages at a time in each process (default 4).")
     args = ap.parse_args()
 
     if args.demo is not None:
@@ -587,14 +1049,18 @@ To actually do anything, you need one of the following:
         print("ERROR: must give an output PDF file --output")
         ap.print_help()
         sys.exit(1)
+    # Generators, so that huge ID ranges never need to be held in memory
     if args.id_file is not None:
-        ids = [x.strip() for x in args.id_file.readlines()]
+        ids = (x.strip() for x in args.id_file)
     else:
-        ids = [args.id_format.format(i) for i in range(args.id_start, args.id_end+1)]
+        ids = (args.id_format.format(i) for i in range(args.id_start, args.id_end+1))
 
-    sht = generate_labels(label_types[args.label_type](layout=args.layout, qrsize=args.qr_size, background=args.background, font_size=args.font_size, vmargin=args.vmargin, hmargin=args.hmargin, line_delim=args.line_delim),
-            ids, copies=args.copies, border=args.border)
-    sht.save(args.output)
+    labeltype = label_types[args.label_type](layout=args.layout, qrsize=args.qr_size, background=args.background, font_size=args.font_size, vmargin=args.vmargin, hmargin=args.hmargin, line_delim=args.line_delim)
+    if args.threads > 1:
+        generate_labels_parallel(labeltype, ids, args.output, copies=args.copies, border=args.border,
+                                 threads=args.threads, pages_per_chunk=args.pages_per_chunk)
+        return
+    generate_labels(labeltype, ids, copies=args.copies, border=args.border, output=args.output)
 
 
 if __name__ == "__main__":
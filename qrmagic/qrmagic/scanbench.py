@@ -0,0 +1,144 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from .scanimages import ImgData, LOG
+from .scanstrategy import get_strategies, DEFAULT_STRATEGIES, STRATEGIES
+
+from tqdm import tqdm
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+
+def read_corpus(fh):
+    """Read a corpus file of tab-separated image paths and expected QR codes
+    (separated by ';', empty if the image has none). Paths are relative to
+    the corpus file. Returns a list of (path, set of codes)."""
+    base = os.path.dirname(os.path.abspath(fh.name)) if hasattr(fh, "name") else "."
+    corpus = []
+    for line in fh:
+        line = line.rstrip("\n")
+        if not line or line.startswith("#"):
+            continue
+        path, _, codes = line.partition("\t")
+        codes = set(c.strip() for c in codes.split(";") if c.strip())
+        corpus.append((os.path.join(base, path), codes))
+    return corpus
+
+
+def percentile(values, q):
+    """The q'th percentile of values, interpolating between ranks."""
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def _init_worker(strategy_names):
+    # Strategies hold closures, which can't be pickled, so are looked up again
+    # by name in each worker
+    ImgData.STRATEGIES = get_strategies(strategy_names)
+
+
+def _bench_image(item):
+    path, expected = item
+    start = time.perf_counter()
+    img = ImgData(path)
+    seconds = time.perf_counter() - start
+    return path, expected, img.qrcode or [], len(img.attempts), seconds
+
+
+def run_benchmark(corpus, strategies, threads=1):
+    """Scan every image in `corpus` with ImgData using `strategies`, and
+    return per-image results as a list of dicts. Images listed more than
+    once in the corpus are scanned and counted each time."""
+    names = [s.name for s in strategies]
+    results = []
+    with mp.Pool(threads, initializer=_init_worker, initargs=(names,)) as pool:
+        for path, expected, codes, attempts, seconds in tqdm(pool.imap_unordered(_bench_image, corpus),
+                                                             total=len(corpus), unit="images"):
+            codes = set(codes)
+            results.append({
+                "image": path,
+                "expected": sorted(expected),
+                "found": sorted(codes & expected),
+                "false_positives": sorted(codes - expected),
+                "attempts": attempts,
+                "seconds": seconds,
+            })
+    return results
+
+
+def summarise(results, wall_seconds, threads):
+    n_expected = sum(len(r["expected"]) for r in results)
+    n_found = sum(len(r["found"]) for r in results)
+    with_codes = [r for r in results if r["expected"]]
+    latencies = [r["seconds"] for r in results]
+    cpu_seconds = sum(latencies)
+    return {
+        "images": len(results),
+        "expected_codes": n_expected,
+        "found_codes": n_found,
+        "recall": round(n_found / n_expected, 4) if n_expected else None,
+        "image_recall": round(sum(len(r["found"]) == len(r["expected"]) for r in with_codes) / len(with_codes), 4) if with_codes else None,
+        "false_positives": sum(len(r["false_positives"]) for r in results),
+        "images_with_false_positives": sum(bool(r["false_positives"]) for r in results),
+        "latency_p50": round(percentile(latencies, 50), 4) if latencies else None,
+        "latency_p95": round(percentile(latencies, 95), 4) if latencies else None,
+        "attempts_per_image": round(sum(r["attempts"] for r in results) / len(results), 3) if results else None,
+        "images_per_sec": round(len(results) / wall_seconds, 3) if wall_seconds else None,
+        "images_per_core_sec": round(len(results) / cpu_seconds, 3) if cpu_seconds else None,
+        "threads": threads,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="qrmagic-scanbench",
+            description="Measure QR detection accuracy and speed on a corpus of images with known codes.")
+    ap.add_argument("corpus", type=argparse.FileType("r"),
+            help="Tab-separated file of image paths (relative to this file) and their expected QR codes, separated by ';'. Leave the codes empty for images without any.")
+    ap.add_argument("-t", "--threads", type=int, default=mp.cpu_count(),
+            help="Number of CPUs to use for image decoding/scanning")
+    ap.add_argument("-s", "--strategies", action="append",
+            help="Comma-separated strategy ladder to benchmark, 'default' for the production ladder, or 'all'. May be given more than once to compare ladders (default: 'default').")
+    ap.add_argument("--each-strategy", action="store_true",
+            help="Also benchmark every available strategy on its own.")
+    ap.add_argument("-o", "--output", type=argparse.FileType("a"), default=sys.stdout,
+            help="Append one JSON summary line per ladder to this file (default stdout).")
+    ap.add_argument("--per-image", type=argparse.FileType("w"), metavar="FILE",
+            help="Write each image's results to FILE as ND-JSON.")
+    args = ap.parse_args()
+
+    corpus = read_corpus(args.corpus)
+    ladders = ["default"] if args.strategies is None else list(args.strategies)
+    if args.each_strategy:
+        ladders.extend(STRATEGIES)
+    for ladder in ladders:
+        try:
+            strategies = get_strategies(DEFAULT_STRATEGIES if ladder == "default" else ladder)
+        except ValueError as exc:
+            ap.error(str(exc))
+        LOG.info("Benchmarking %s", ladder)
+        start = time.perf_counter()
+        results = run_benchmark(corpus, strategies, threads=args.threads)
+        summary = summarise(results, time.perf_counter() - start, args.threads)
+        summary = {"strategies": ladder, **summary}
+        print(json.dumps(summary), file=args.output, flush=True)
+        if args.per_image is not None:
+            for result in results:
+                print(json.dumps({"strategies": ladder, **result}), file=args.per_image)
+
+
+if __name__ == "__main__":
+    main()
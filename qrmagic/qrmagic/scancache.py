@@ -0,0 +1,134 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def file_digest(path, bufsize=1<<20):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as fh:
+        while True:
+            buf = fh.read(bufsize)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+class ScanCache(object):
+    """On-disk cache of qrmagic-detect results.
+
+    Entries are keyed on the file's content hash and the scanner
+    configuration, so renamed or copied images are still cache hits. The
+    path, size and mtime of each file are also stored so that unchanged files
+    can be looked up without re-reading (and re-hashing) them.
+    """
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+        # path -> (abspath, size, mtime, digest) of misses, as they were when
+        # looked up, for put() to store the scan result under
+        self._missed = {}
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS scans (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                config TEXT NOT NULL,
+                result TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (path, config)
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS scans_digest ON scans (digest, config)")
+        self.db.commit()
+
+    def _stat(self, path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    def get(self, path):
+        """Return the cached response JSON for `path`, or None on a miss."""
+        try:
+            apath, size, mtime = self._stat(path)
+        except OSError:
+            self.misses += 1
+            return None
+        row = self.db.execute(
+            "SELECT result FROM scans WHERE path=? AND config=? AND size=? AND mtime_ns=?",
+            (apath, self.config, size, mtime)).fetchone()
+        if row is None:
+            digest = file_digest(path)
+            row = self.db.execute(
+                "SELECT result FROM scans WHERE digest=? AND config=? LIMIT 1",
+                (digest, self.config)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._missed[path] = (apath, size, mtime, digest)
+                return None
+            self._put(apath, size, mtime, digest, row[0])
+        else:
+            self.db.execute("UPDATE scans SET last_used=? WHERE path=? AND config=?",
+                            (time.time(), apath, self.config))
+        self.hits += 1
+        result = json.loads(row[0])
+        result["filename"] = os.path.basename(path)
+        return result
+
+    def put(self, path, result):
+        """Store the scan result for `path`. Files that missed in get() are
+        stored as they were then, so neither re-read nor re-hashed, and a
+        file that changes during its scan isn't stored under its new mtime."""
+        try:
+            apath, size, mtime, digest = self._missed.pop(path)
+        except KeyError:
+            try:
+                apath, size, mtime = self._stat(path)
+                digest = file_digest(path)
+            except OSError:
+                return
+        self._put(apath, size, mtime, digest, json.dumps(result))
+
+    def discard(self, path):
+        """Forget a miss whose scan failed, so nothing is stored for it."""
+        self._missed.pop(path, None)
+
+    def _put(self, apath, size, mtime, digest, result):
+        self.db.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (apath, size, mtime, digest, self.config, result, time.time()))
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def invalidate(self):
+        """Drop every cached result."""
+        self.db.execute("DELETE FROM scans")
+        self.db.commit()
+
+    def prune(self):
+        """Drop results from other scanner configurations, and results for
+        files that no longer exist. Returns the number of entries removed."""
+        stale = [(p, c) for p, c in self.db.execute("SELECT path, config FROM scans")
+                 if c != self.config or not os.path.exists(p)]
+        self.db.executemany("DELETE FROM scans WHERE path=? AND config=?", stale)
+        self.db.commit()
+        return len(stale)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -7,7 +7,6 @@
 
 from sys import stderr
 from PIL import Image
-from PIL import Image, ImageOps, ImageEnhance, ImageDraw, ImageFont
 import piexif
 try:
     import HeifImagePlugin
@@ -27,13 +26,17 @@ import shutil
 from pathlib import Path
 import datetime as dt
 import json
-import base64
+import time
 from io import BytesIO
 from urllib.request import urlopen
+from collections import deque
 import multiprocessing as mp
 
+from .scancache import ScanCache
+from .thumbnails import InlineThumbnails, ThumbnailDir, ThumbnailPack
+from .scanstrategy import get_strategies, StrategyStats, DEFAULT_STRATEGIES, STRATEGIES
+
 # TODO: make scale_image a separate function, reduce duplication
-# TODO: PIL image to jpeg dataurl helper function
 
 
 def get_logger(level=INFO):
@@ -54,47 +57,119 @@ def dataURI_to_file(uri):
 
 class ImgData(object):
     MIDSIZE_HEIGHT = 720
+    STRATEGIES = get_strategies(DEFAULT_STRATEGIES)
+    # Bump this whenever a change to the scanner could change its results, so
+    # that cached results from older versions are not reused.
+    SCANNER_VERSION = 3
 
     def __init__(self, path=None, filename=None, data=None):
-        self.qrcode = None
-        self.camera = None
-        self.datetime = None
-        self.lat = None
-        self.lon = None
-        self.alt = None
-        self.midsize = None
         filedata = None
         if path is not None:
-            self.filename = Path(path).name
+            filename = Path(path).name
             filedata = path
         else:
             assert filename is not None and data is not None
             filedata = data
-            self.filename = filename
+        self._blank(filename)
+        self._source = filedata
         try:
+            # Image.open only reads the header, so size and EXIF are available
+            # without decoding any pixel data.
             self.image = Image.open(filedata)
-            self.midsize = self.scale_img(h=self.MIDSIZE_HEIGHT)
             self.width, self.height = self.image.size
+            self.midsize_jpeg = self.scale_img(h=self.MIDSIZE_HEIGHT)
             self.scan_codes()
-            self.parse_exif()
-            del self.image
         except Exception as exc:
             LOG.error("Couldn't read or process image '%s'", self.filename, exc_info=exc)
             LOG.info("ERROR: %s", str(exc))
+            # So that the failure isn't cached as an image without codes
+            self.error = str(exc)
+        else:
+            try:
+                self.parse_exif()
+            except KeyError:
+                # No EXIF or GPS data, which is not an error
+                LOG.debug("No EXIF location for image '%s'", self.filename)
+            except Exception as exc:
+                LOG.warning("Couldn't parse EXIF of image '%s': %s", self.filename, exc)
+        finally:
+            self.image = None
+            self._decoded = []
+            self._source = None
+
+    def _blank(self, filename):
+        self.filename = filename
+        self.qrcode = None
+        self.camera = None
+        self.datetime = None
+        self.lat = None
+        self.lon = None
+        self.alt = None
+        self.midsize_jpeg = None
+        self.attempts = []
+        self.error = None
+        self._decoded = []
+
+    @classmethod
+    def failed(cls, path, error):
+        """An empty ImgData for an image that could not be scanned at all,
+        e.g. because scanning it timed out."""
+        LOG.error("Couldn't read or process image '%s': %s", path, error)
+        img = cls.__new__(cls)
+        img._blank(Path(path).name)
+        img.error = error
+        return img
+
+    def reduced_image(self, scalar):
+        """Decode the image at the smallest resolution that is at least
+        `scalar` times the full size.
+
+        For JPEGs this uses PIL's draft mode, which lets libjpeg do DCT scaling
+        so that pixels we would throw away are never decoded. Formats without
+        draft support are decoded once at full size. Decoded images are cached
+        for the lifetime of this ImgData, so later scales reuse them.
+        """
+        want = (max(1, int(self.width*scalar)), max(1, int(self.height*scalar)))
+        fits = [img for img in self._decoded
+                if img.size[0] >= want[0] and img.size[1] >= want[1]]
+        if fits:
+            return min(fits, key=lambda img: img.size[0])
+        if isinstance(self._source, (str, os.PathLike)):
+            image = Image.open(self._source)
+        else:
+            self._source.seek(0)
+            image = Image.open(self._source)
+        if scalar < 1:
+            image.draft("RGB", want)
+        image.load()
+        LOG.debug("decoded %s at %r for scalar %r", self.filename, image.size, scalar)
+        self._decoded.append(image)
+        return image
 
     def scale_img(self,h):
         try:
-            x, y = self.image.size
+            x, y = self.width, self.height
             if x == 0 or y == 0:
                 return None
             scalar = 1 if h > y else h/y
-            img_scaled = self.image.resize((int(round(x*scalar)), int(round(y*scalar))))
+            size = (int(round(x*scalar)), int(round(y*scalar)))
+            image = self.reduced_image(scalar)
+            img_scaled = image if image.size == size else image.resize(size)
             buf = BytesIO()
-            img_scaled.save(buf, format="JPEG")
-            b64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-            return f"data:image/jpeg;charset=utf-8;base64,{b64}"
+            img_scaled.convert("RGB").save(buf, format="JPEG")
+            return buf.getvalue()
         except Exception:
-            return ""
+            return None
+
+    @classmethod
+    def config_key(cls, **extra):
+        """Everything that affects the output of a scan, as a string."""
+        return json.dumps({
+            "version": cls.SCANNER_VERSION,
+            "midsize_height": cls.MIDSIZE_HEIGHT,
+            "strategies": sorted(s.name for s in cls.STRATEGIES),
+            **extra,
+        }, sort_keys=True)
 
     def __repr__(self):
         return f"qr={self.qrcode} dt={self.datetime} lt={self.lat} ln={self.lon} at={self.alt} cm={self.camera}"
@@ -118,25 +193,26 @@ class ImgData(object):
         self.lat, self.lon, self.alt = parse_latlonalt(exif_dict["GPS"])
     
     def scan_codes(self):
+        """Try each strategy in self.STRATEGIES in turn until one decodes a QR
+        code. Each attempt is recorded in self.attempts as (strategy name,
+        success, seconds) so the ladder can be reordered between runs."""
         self.qrcode = None
-        x, y = self.image.size
-        image = ImageOps.grayscale(self.image)
-        for scalar in [0.2, 0.5, 0.1, 1.0]:
-            LOG.debug("scalar is: %r", scalar)
-            img_scaled = image.resize((int(x*scalar), int(y*scalar)))
-            for sharpness in [0.1, 0.5, 1.5]:
-                LOG.debug("sharpness is: %r", scalar)
-                if sharpness != 1:
-                    sharpener = ImageEnhance.Sharpness(img_scaled)
-                    img_scaled = sharpener.enhance(sharpness)
-
-                    codes = decode(img_scaled, [ZBarSymbol.QRCODE,])
-                    if len(codes) > 0:
-                        self.qrcode = list(set([d.data.decode('utf8').strip() for d in codes]))
-                        LOG.debug("got codes: %r", self.qrcode)
-                        return
-
-    def as_response_json(self):
+        for strategy in self.STRATEGIES:
+            LOG.debug("strategy is: %r", strategy.name)
+            start = time.monotonic()
+            codes = decode(strategy.prepare(self), [ZBarSymbol.QRCODE,])
+            self.attempts.append((strategy.name, len(codes) > 0, time.monotonic() - start))
+            if len(codes) > 0:
+                self.qrcode = list(set([d.data.decode('utf8').strip() for d in codes]))
+                LOG.debug("got codes: %r", self.qrcode)
+                return
+
+    def as_response_json(self, thumbnails=None):
+        """The scan result as a JSON-able dict. By default the midsize
+        preview is embedded as a data URI; `thumbnails` (see
+        qrmagic.thumbnails) can instead store it elsewhere and refer to it."""
+        if thumbnails is None:
+            thumbnails = InlineThumbnails()
         return {
             "filename": self.filename,
             "qrcodes": self.qrcode,
@@ -145,7 +221,7 @@ class ImgData(object):
             "lat": self.lat,
             "lng": self.lon,
             "alt": self.alt,
-            "midsize": self.midsize,
+            **thumbnails.fields(self.midsize_jpeg),
         }
 
 
@@ -185,6 +261,183 @@ def parse_latlonalt(G):
     return lat, lon, alt
 
 
+def read_image_list(fh, null=False):
+    """Lazily yield paths from a file of image paths, one per line or
+    separated by NUL bytes (e.g. from `find -print0`)."""
+    if not null:
+        for line in fh:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+        return
+    buf = ""
+    while True:
+        block = fh.read(65536)
+        if not block:
+            break
+        buf += block
+        *paths, buf = buf.split("\0")
+        yield from (p for p in paths if p)
+    if buf:
+        yield buf
+
+
+def _init_worker(strategy_names, midsize_height):
+    # Settings made on ImgData by the parent aren't inherited by spawned
+    # workers, and strategies hold closures, which can't be pickled, so they
+    # are looked up again by name
+    ImgData.STRATEGIES = get_strategies(strategy_names)
+    ImgData.MIDSIZE_HEIGHT = midsize_height
+
+
+def _scan_chunk(paths):
+    return [ImgData(path) for path in paths]
+
+
+class _ScanTask(object):
+    def __init__(self, slot, paths):
+        self.slot = slot
+        self.paths = paths
+        self.result = None
+        self.started = None
+
+    def submit(self, pool):
+        self.result = pool.apply_async(_scan_chunk, (self.paths,))
+        self.started = None
+
+
+def scan_images(paths, threads=1, window=None, chunksize=1, timeout=None, ordered=False, lookup=None):
+    """Scan an iterable of image paths, yielding (path, ImgData, cached)
+    tuples as they complete.
+
+    `paths` is consumed lazily and at most `window` images are in flight
+    (submitted to the worker pool, or finished but waiting to be output) at
+    once, so memory use is bounded however many images there are. Images are
+    sent to workers in chunks of `chunksize`. With `ordered`, results are
+    yielded in the order of `paths`, otherwise as soon as they are ready.
+
+    `lookup(path)` may return a previously computed response JSON for an
+    image; these are yielded as (path, None, cached) without being scanned.
+
+    If a chunk takes longer than `timeout` seconds per image once a worker has
+    started on it, its images are reported as failed and the worker pool is
+    restarted, so that e.g. a corrupt HEIF can't stall the whole batch.
+    Timeouts are only supported with threads > 1.
+    """
+    if threads <= 1:
+        for path in paths:
+            cached = lookup(path) if lookup is not None else None
+            if cached is not None:
+                yield path, None, cached
+            else:
+                yield path, ImgData(path), None
+        return
+
+    if window is None:
+        window = threads * chunksize * 4
+    source = iter(paths)
+    exhausted = False
+    pending = deque()   # _ScanTasks in submission order
+    finished = {}       # slot -> list of (path, ImgData, cached)
+    next_slot = 0       # slot number of the next task or cached result
+    next_out = 0        # slot number of the next output, for ordered mode
+    n_finished = 0      # number of images in finished
+
+    def new_pool():
+        return mp.Pool(threads, initializer=_init_worker,
+                       initargs=([s.name for s in ImgData.STRATEGIES], ImgData.MIDSIZE_HEIGHT))
+
+    pool = new_pool()
+    try:
+        while True:
+            # Top up the in-flight window from the source iterator.
+            chunk = None
+            while not exhausted and sum(len(t.paths) for t in pending) + n_finished < window:
+                try:
+                    path = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                cached = lookup(path) if lookup is not None else None
+                if cached is not None:
+                    if chunk is not None:
+                        chunk.submit(pool)
+                        chunk = None
+                    finished[next_slot] = [(path, None, cached)]
+                    n_finished += 1
+                    next_slot += 1
+                    continue
+                if chunk is None:
+                    chunk = _ScanTask(next_slot, [])
+                    pending.append(chunk)
+                    next_slot += 1
+                chunk.paths.append(path)
+                if len(chunk.paths) >= chunksize:
+                    chunk.submit(pool)
+                    chunk = None
+            if chunk is not None:
+                chunk.submit(pool)
+
+            if not pending and not finished:
+                break
+
+            # Collect completed tasks, and time out any that have been running
+            # too long. The pool works through tasks in submission order, so a
+            # task is running once fewer than `threads` earlier ones remain.
+            now = time.monotonic()
+            running = 0
+            timed_out = None
+            for task in list(pending):
+                if task.result.ready():
+                    try:
+                        imgs = task.result.get()
+                    except Exception as exc:
+                        imgs = [ImgData.failed(p, str(exc)) for p in task.paths]
+                    finished[task.slot] = [(p, img, None) for p, img in zip(task.paths, imgs)]
+                    n_finished += len(task.paths)
+                    pending.remove(task)
+                    continue
+                if running < threads and task.started is None:
+                    task.started = now
+                running += 1
+                if timeout is not None and task.started is not None and \
+                        now - task.started > timeout * len(task.paths):
+                    timed_out = task
+            if timed_out is not None:
+                finished[timed_out.slot] = [
+                    (p, ImgData.failed(p, f"timed out after {timeout}s"), None)
+                    for p in timed_out.paths]
+                n_finished += len(timed_out.paths)
+                pending.remove(timed_out)
+                pool.terminate()
+                pool.join()
+                pool = new_pool()
+                for task in pending:
+                    task.submit(pool)
+
+            # Output whatever is ready.
+            if ordered:
+                slots = []
+                while next_out in finished:
+                    slots.append(next_out)
+                    next_out += 1
+            else:
+                slots = sorted(finished)
+            for slot in slots:
+                results = finished.pop(slot)
+                n_finished -= len(results)
+                yield from results
+
+            if pending and not any(t.result.ready() for t in pending):
+                pending[0].result.wait(0.05)
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+
 def climain():
     extrahelp = """
     This program detects QRcodes and other metadata in a folder of images, and
@@ -197,17 +450,97 @@ def climain():
             help="ND-JSON output file.")
     ap.add_argument("-z", "--img-height", type=int, default=720,
             help="Preview image size (height, aspect ratio is preserved).")
-    ap.add_argument("images", nargs="+", help="List of images")
+    thumbs = ap.add_mutually_exclusive_group()
+    thumbs.add_argument("--thumbnail-dir", metavar="DIR",
+            help="Write preview images as files in DIR and refer to them by path (midsize_path), rather than embedding them in the output.")
+    thumbs.add_argument("--thumbnail-pack", metavar="FILE",
+            help="Append preview images to FILE and refer to them by [file, offset, length] (midsize_pack), rather than embedding them in the output.")
+    ap.add_argument("--thumbnail-url", metavar="PREFIX",
+            help="With --thumbnail-dir, refer to preview images by URL (midsize), as PREFIX followed by their path within DIR, e.g. when DIR is served at PREFIX.")
+    ap.add_argument("-c", "--cache", metavar="FILE",
+            help="Cache scan results in this SQLite file, and skip re-scanning images already in it.")
+    ap.add_argument("--cache-invalidate", action="store_true",
+            help="Discard all cached results before scanning.")
+    ap.add_argument("--cache-prune", action="store_true",
+            help="Remove cached results for deleted images or other scanner settings.")
+    ap.add_argument("-s", "--strategies", default=",".join(DEFAULT_STRATEGIES),
+            help="Comma-separated decoding strategies to try, or 'all'. Strategies are named "
+                 "SCALE-TRANSFORM, e.g. 0.2-sharpen0.1 or 0.5-autocontrast. Available: " + ", ".join(STRATEGIES))
+    ap.add_argument("--strategy-stats", metavar="FILE",
+            help="JSON file of per-strategy success rates and timings. Strategies are tried in "
+                 "order of expected time to a successful decode, and the file is updated after each run.")
+    ap.add_argument("-i", "--image-list", type=argparse.FileType("r"), metavar="FILE",
+            help="Read image paths from FILE ('-' for stdin), one per line. Paths are read as they are needed, so this suits very large batches.")
+    ap.add_argument("-0", "--null", action="store_true",
+            help="Paths given to --image-list are separated by NUL bytes, as from `find -print0`.")
+    ap.add_argument("--ordered", action="store_true",
+            help="Write results in the same order as the input images, rather than as soon as each is ready.")
+    ap.add_argument("--window", type=int, metavar="N",
+            help="Maximum number of images in flight at once (default: 4 chunks per thread).")
+    ap.add_argument("--chunksize", type=int, default=1, metavar="N",
+            help="Number of images sent to a worker at a time.")
+    ap.add_argument("--timeout", type=float, default=120, metavar="SECS",
+            help="Give up on an image after this many seconds (only with --threads > 1).")
+    ap.add_argument("images", nargs="*", help="List of images")
     args = ap.parse_args()
+    if not args.images and args.image_list is None:
+        ap.error("Give either images or --image-list")
+    if args.thumbnail_url is not None and args.thumbnail_dir is None:
+        ap.error("--thumbnail-url needs --thumbnail-dir")
 
-    # Setup output
-    if args.threads > 1:
-        pool = mp.Pool(args.threads)
-        map_ = pool.imap
+    ImgData.MIDSIZE_HEIGHT = args.img_height
+    try:
+        strategies = get_strategies(args.strategies)
+    except ValueError as exc:
+        ap.error(str(exc))
+    stats = StrategyStats(args.strategy_stats)
+    ImgData.STRATEGIES = stats.order(strategies)
+    LOG.debug("strategy order: %s", ", ".join(s.name for s in ImgData.STRATEGIES))
+
+    if args.thumbnail_dir is not None:
+        thumbnails = ThumbnailDir(args.thumbnail_dir, url_prefix=args.thumbnail_url)
+    elif args.thumbnail_pack is not None:
+        thumbnails = ThumbnailPack(args.thumbnail_pack)
     else:
-        map_ = map
+        thumbnails = InlineThumbnails()
 
-    ImgData.MIDSIZE_HEIGHT = args.img_height
+    cache = None
+    if args.cache is not None:
+        cache = ScanCache(args.cache, ImgData.config_key(thumbnails=thumbnails.key))
+        if args.cache_invalidate:
+            cache.invalidate()
+        if args.cache_prune:
+            LOG.info("Pruned %d stale entries from scan cache", cache.prune())
+
+    if args.image_list is not None:
+        images = read_image_list(args.image_list, null=args.null)
+        total = None
+    else:
+        images = args.images
+        total = len(args.images)
+
+    # Cached results are written as they are found, and only new or changed
+    # images are sent to be scanned.
+    results = scan_images(images, threads=args.threads, window=args.window,
+                          chunksize=args.chunksize, timeout=args.timeout,
+                          ordered=args.ordered,
+                          lookup=cache.get if cache is not None else None)
+    for path, img, cached in tqdm(results, unit="images", total=total):
+        if cached is not None:
+            print(json.dumps(cached), file=args.output)
+            continue
+        result = img.as_response_json(thumbnails)
+        print(json.dumps(result), file=args.output)
+        if cache is not None:
+            if img.error is None:
+                cache.put(path, result)
+            else:
+                cache.discard(path)
+        for name, success, seconds in img.attempts:
+            stats.record(name, success, seconds)
+    stats.save()
+    thumbnails.close()
 
-    for img in tqdm(map_(ImgData, args.images), unit="images", total=len(args.images)):
-        print(json.dumps(img.as_response_json()), file=args.output)
+    if cache is not None:
+        LOG.info("Scan cache: %d hits, %d misses", cache.hits, cache.misses)
+        cache.close()
@@ -0,0 +1,133 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from PIL import Image, ImageOps, ImageEnhance
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+import json
+import os
+
+
+def sharpen(amount):
+    def transform(image):
+        return ImageEnhance.Sharpness(image).enhance(amount)
+    return transform
+
+
+def autocontrast(image):
+    return ImageOps.autocontrast(image)
+
+
+def clahe(image):
+    return Image.fromarray(cv2.createCLAHE().apply(np.asarray(image)))
+
+
+def rotate(degrees):
+    def transform(image):
+        return image.rotate(degrees, expand=1)
+    return transform
+
+
+class Strategy(object):
+    """One attempt at decoding an image: grayscale it at `scalar` times its
+    full size, apply `transform`, and hand the result to zbar."""
+
+    def __init__(self, name, scalar, transform=None):
+        self.name = name
+        self.scalar = scalar
+        self.transform = transform
+
+    def prepare(self, imgdata):
+        x, y = imgdata.width, imgdata.height
+        image = ImageOps.grayscale(imgdata.reduced_image(self.scalar))
+        size = (int(x*self.scalar), int(y*self.scalar))
+        if image.size != size:
+            image = image.resize(size)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image
+
+    def __repr__(self):
+        return f"Strategy({self.name})"
+
+
+TRANSFORMS = {
+    "sharpen0.1": sharpen(0.1),
+    "sharpen0.5": sharpen(0.5),
+    "sharpen1.5": sharpen(1.5),
+    "autocontrast": autocontrast,
+    "rotate30": rotate(30),
+}
+if cv2 is not None:
+    TRANSFORMS["clahe"] = clahe
+
+STRATEGIES = {}
+for _scalar in [0.1, 0.2, 0.5, 1.0]:
+    for _tname, _transform in TRANSFORMS.items():
+        _name = f"{_scalar}-{_tname}"
+        STRATEGIES[_name] = Strategy(_name, _scalar, _transform)
+
+DEFAULT_STRATEGIES = [f"{scalar}-{sharpness}"
+                      for scalar in ["0.2", "0.5", "0.1", "1.0"]
+                      for sharpness in ["sharpen0.1", "sharpen0.5", "sharpen1.5"]]
+
+
+def get_strategies(names):
+    """Look up a list of strategy names, or 'all'."""
+    if names == "all":
+        return list(STRATEGIES.values())
+    if isinstance(names, str):
+        names = names.split(",")
+    try:
+        return [STRATEGIES[n.strip()] for n in names]
+    except KeyError as exc:
+        raise ValueError(f"Unknown scan strategy {exc}. Valid strategies are: {', '.join(STRATEGIES)}")
+
+
+class StrategyStats(object):
+    """Per-strategy counts of attempts, successes, and time taken, used to
+    order a strategy ladder so that strategies with the lowest expected time
+    to a successful decode are tried first."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.stats = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as fh:
+                self.stats = json.load(fh)
+
+    def record(self, name, success, seconds):
+        st = self.stats.setdefault(name, {"attempts": 0, "successes": 0, "seconds": 0.0})
+        st["attempts"] += 1
+        st["successes"] += int(bool(success))
+        st["seconds"] += seconds
+
+    def expected_cost(self, name):
+        """Mean time per attempt divided by the (Laplace-smoothed) success
+        rate. Strategies that have never been tried cost nothing, so that they
+        are tried early and get measured."""
+        st = self.stats.get(name)
+        if not st or not st["attempts"]:
+            return 0.0
+        p_success = (st["successes"] + 1) / (st["attempts"] + 2)
+        return (st["seconds"] / st["attempts"]) / p_success
+
+    def order(self, strategies):
+        if not self.stats:
+            return list(strategies)
+        # sorted() is stable, so ties keep the ladder's order
+        return sorted(strategies, key=lambda s: self.expected_cost(s.name))
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path, "w") as fh:
+            json.dump(self.stats, fh, indent=2, sort_keys=True)
@@ -0,0 +1,111 @@
+# Copyright 2021-2022  Kevin Murray, MPI Biologie Tübingen
+# Copyright 2021-2022  Gekkonid Consulting
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import hashlib
+import os
+import tempfile
+import time
+
+from .diskcache import evict_lru
+
+
+def jpeg_dataurl(jpeg):
+    b64 = base64.b64encode(jpeg).decode('utf-8')
+    return f"data:image/jpeg;charset=utf-8;base64,{b64}"
+
+
+class InlineThumbnails(object):
+    """Embed thumbnails in each record as a base64 data URI (the default)."""
+    key = "inline"
+
+    def fields(self, jpeg):
+        return {"midsize": jpeg_dataurl(jpeg) if jpeg else None}
+
+    def close(self):
+        pass
+
+
+class ThumbnailDir(object):
+    """Write thumbnails as files in a content-addressed directory, named by
+    the SHA-1 of their contents, and refer to them by path (or by URL, if
+    `url_prefix` is given).
+
+    If `ttl` or `max_bytes` is given, thumbnails not stored again within
+    `ttl` seconds, and the least recently stored ones beyond `max_bytes`, are
+    deleted. This is checked at most every EVICT_INTERVAL seconds.
+    """
+    EVICT_INTERVAL = 60
+
+    def __init__(self, path, url_prefix=None, ttl=None, max_bytes=None):
+        self.path = path
+        self.url_prefix = url_prefix
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.key = f"dir:{os.path.abspath(path)}:{url_prefix}"
+        self._last_evict = 0
+        os.makedirs(path, exist_ok=True)
+
+    def store(self, jpeg):
+        """Store `jpeg` if it isn't already, and return its name relative to
+        the thumbnail directory."""
+        digest = hashlib.sha1(jpeg).hexdigest()
+        name = f"{digest[:2]}/{digest}.jpg"
+        outpath = os.path.join(self.path, name)
+        try:
+            # Refresh the mtime, so that thumbnails still in use aren't evicted
+            os.utime(outpath)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            # Write then rename, so concurrent writers never expose a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(outpath), suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(jpeg)
+            os.replace(tmp, outpath)
+        if (self.ttl is not None or self.max_bytes is not None) \
+                and time.time() - self._last_evict > self.EVICT_INTERVAL:
+            self.evict()
+        return name
+
+    def evict(self):
+        """Delete expired thumbnails, then the least recently stored ones
+        until the directory fits in max_bytes."""
+        self._last_evict = time.time()
+        evict_lru(self.path, self.max_bytes, ttl=self.ttl)
+
+    def fields(self, jpeg):
+        if not jpeg:
+            return {"midsize": None}
+        name = self.store(jpeg)
+        if self.url_prefix is not None:
+            return {"midsize": self.url_prefix + name}
+        return {"midsize": None, "midsize_path": os.path.join(self.path, name)}
+
+    def close(self):
+        pass
+
+
+class ThumbnailPack(object):
+    """Append thumbnails to a single pack file, and refer to them by
+    [pack path, byte offset, length]. The pack is only ever appended to, so
+    references from earlier runs stay valid."""
+
+    def __init__(self, path):
+        self.path = path
+        self.key = f"pack:{os.path.abspath(path)}"
+        self.fh = open(path, "ab")
+
+    def fields(self, jpeg):
+        if not jpeg:
+            return {"midsize": None}
+        self.fh.seek(0, os.SEEK_END)
+        offset = self.fh.tell()
+        self.fh.write(jpeg)
+        return {"midsize": None, "midsize_pack": [self.path, offset, len(jpeg)]}
+
+    def close(self):
+        self.fh.close()
@@ -23,6 +23,13 @@ const MAX_REQUESTS_COUNT = 5
 const INTERVAL_MS = 10
 let PENDING_REQUESTS = 0
 
+// Images are uploaded in batches of JOB_BATCH_SIZE, each scanned as a job on
+// the server, with up to JOB_CONCURRENCY jobs running at once.
+const JOB_BATCH_SIZE = 50
+const JOB_CONCURRENCY = 2
+const JOB_POLL_MS = 1000
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 axios.interceptors.request.use(function (config) {
 	  return new Promise((resolve, reject) => {
 		      let interval = setInterval(() => {
@@ -43,16 +50,22 @@ axios.interceptors.response.use(function (response) {
 	  return Promise.reject(error)
 })
 
-
-function readFile(file){
-  return new Promise((resolve, reject) => {
-    var fr = new FileReader();  
-    fr.onload = () => {
-      resolve(fr.result )
-    };
-    fr.onerror = reject;
-    fr.readAsDataURL(file);
-  });
+// The preview image of an ND-JSON record from qrmagic-detect. Previews
+// written with --thumbnail-pack or --thumbnail-dir are read from the pack
+// file or thumbnail files selected along with the ND-JSON, found by name.
+function previewURL(d, files) {
+    const basename = (path) => path.split(/[\\/]/).pop();
+    if (d.midsize) return d.midsize;
+    if (d.midsize_pack) {
+        const [pack, offset, length] = d.midsize_pack;
+        const file = files[basename(pack)];
+        if (file) return URL.createObjectURL(file.slice(offset, offset + length, "image/jpeg"));
+    }
+    if (d.midsize_path) {
+        const file = files[basename(d.midsize_path)];
+        if (file) return URL.createObjectURL(file);
+    }
+    return null;
 }
 
 var vm = new Vue({
@@ -72,10 +85,20 @@ var vm = new Vue({
         async onJSONUpload(e) {
             var files = e.target.files || e.dataTransfer.files;
             if (!files.length) return;
-            const jsonfile = files[0];
+            // Any other files are thumbnail packs or thumbnails, see previewURL
+            var jsonfile = files[0];
+            var others = {};
+            for (const file of files) {
+                if (/\.(nd)?json$/i.test(file.name)) {
+                    jsonfile = file;
+                } else {
+                    others[file.name] = file;
+                }
+            }
             const content = await jsonfile.text();
             const all_parsed = ndjsonParser(content);
             this.progress = {done: 0, total: all_parsed.length};
+            var missing = 0;
             for (let [i, d] of Object.entries(all_parsed)) {
                 if (d.qrcodes) {
                     if (vm.$data.reverse_sort) {
@@ -93,57 +116,101 @@ var vm = new Vue({
                     alt: d.alt,
                     datetime: dtobj,
                     datestr: dtobj ? dtobj.toISOString() : "",
-                    image: d.midsize,
+                    image: previewURL(d, others),
                     filename: d.filename,
                     qrcodes: d.qrcodes,
                 };
+                if (!data.image && (d.midsize_pack || d.midsize_path)) missing += 1;
                 vm.$data.images.push(data);
                 vm.$data.progress.done += 1;
             }
             vm.$data.images.sort((a1, a2) => {return a1.datetime - a2.datetime;})
+            if (missing) {
+                alert(`${missing} images have no preview. Select the thumbnail pack file, or the files in the thumbnail directory, along with the json file.`);
+            }
+        },
+
+        addScanResult(d, filename) {
+            if (d.qrcodes) {
+                if (this.reverse_sort) {
+                    d.qrcodes.sort().reverse();
+                } else {
+                    d.qrcodes.sort();
+                }
+            }
+            const id = d.qrcodes ? d.qrcodes.join(this.qr_sep) : "";
+            const dtobj = d.datetime ? new Date(d.datetime): undefined;
+            var data = {
+                id: id,
+                lat: d.lat,
+                lng: d.lng,
+                alt: d.alt,
+                datetime: dtobj,
+                datestr: dtobj ? dtobj.toISOString() : "",
+                image: d.midsize,
+                filename: filename,
+                qrcodes: d.qrcodes,
+            };
+            this.images.push(data);
+        },
+
+        // Scan a batch of files as one job on the server, adding results as
+        // they are polled for. Images the job never returns (e.g. as the
+        // server lost the job) are still counted as done.
+        async scanBatch(files) {
+            var apidata = new FormData();
+            for (const file of files) {
+                apidata.append("images", file, file.name);
+            }
+            let seen = 0;
+            let job;
+            try {
+                for (;;) {
+                    try {
+                        job = (await axios.post(`${__api_prefix__}jobs`, apidata)).data;
+                        break;
+                    } catch (err) {
+                        // The server is busy with other jobs, so wait our turn
+                        if (!err.response || err.response.status != 429) throw err;
+                        const retry = parseInt(err.response.headers["retry-after"]) || 30;
+                        await sleep(retry * 1000);
+                    }
+                }
+                for (;;) {
+                    const req = await axios.get(`${__api_prefix__}jobs/${job.id}`, {params: {since: seen}});
+                    const st = req.data;
+                    for (const d of st.results) {
+                        this.addScanResult(d, files[d.index].name);
+                        this.progress.done += 1;
+                    }
+                    seen += st.results.length;
+                    if (st.failed) console.log(st.error);
+                    if (st.finished) break;
+                    await sleep(JOB_POLL_MS);
+                }
+            } catch (err) {
+                console.log(err);
+            } finally {
+                this.progress.done += files.length - seen;
+                if (job) axios.delete(`${__api_prefix__}jobs/${job.id}`).catch(console.log);
+            }
         },
 
         async onImageSelect(e) {
-            var files = e.target.files || e.dataTransfer.files;
+            var files = Array.from(e.target.files || e.dataTransfer.files);
             if (!files.length) return;
             this.progress = {done: 0, total: files.length};
-            for (let [i, file] of Object.entries(files)) {
-                var content = await readFile(file);
-                var apidata = {filename: file.name, content: content};
-                axios({method: 'post', url: `${__api_prefix__}scan-image`, data: apidata})
-                .then(function(req) {
-                    if (req.status > 299) console.log(req);
-                    const d = req.data;
-                    if (d.qrcodes) {
-                        if (vm.$data.reverse_sort) {
-                            d.qrcodes.sort().reverse();
-                        } else {
-                            d.qrcodes.sort();
-                        }
-                    }
-                    const id = d.qrcodes ? d.qrcodes.join(vm.$data.qr_sep) : "";
-                    const dtobj = d.datetime ? new Date(d.datetime): undefined;
-                    var data = {
-                        id: id,
-                        lat: d.lat,
-                        lng: d.lng,
-                        alt: d.alt,
-                        datetime: dtobj,
-                        datestr: dtobj ? dtobj.toISOString() : "",
-                        image: d.midsize,
-                        filename: file.name,
-                        qrcodes: d.qrcodes,
-                    };
-                    vm.$data.progress.done += 1;
-                    vm.$data.images.push(data);
-                    if (vm.$data.progress.done == vm.$data.progress.total) {
-                        vm.$data.images.sort((a1, a2) => {return a1.datetime - a2.datetime;})
-                    }
-                }).catch(function(err) {
-                    console.log(err);
-                    vm.$data.progress.done += 1;
-                });
+            let batches = [];
+            for (let i = 0; i < files.length; i += JOB_BATCH_SIZE) {
+                batches.push(files.slice(i, i + JOB_BATCH_SIZE));
             }
+            const scanBatches = async () => {
+                while (batches.length) {
+                    await this.scanBatch(batches.shift());
+                }
+            };
+            await Promise.all(Array.from({length: JOB_CONCURRENCY}, scanBatches));
+            this.images.sort((a1, a2) => {return a1.datetime - a2.datetime;})
         },
 
         async getRenamedZip() {
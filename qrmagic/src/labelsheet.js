@@ -61,6 +61,9 @@ var vm = new Vue({
                 method: 'POST',
                 body: JSON.stringify(req)
             }).then(function(resp) {
+                if (!resp.ok) {
+                    throw new Error(`Couldn't make labels: ${resp.status} ${resp.statusText}`);
+                }
                 return resp.blob();
             }).then(function(blob) {
                 console.log(blob);
@@ -71,6 +74,8 @@ var vm = new Vue({
                 a.click();
                 a.remove();
                 setTimeout(() => URL.revokeObjectURL(a.href), 9000);
+            }).catch(function(err) {
+                alert(err.message);
             });
         },
         async labelTypeUpdate(e) {
@@ -2,35 +2,108 @@
 from . import svglue
 import cairosvg
 import qrcode
-from PyPDF2 import PdfFileMerger
+try:
+    from PyPDF2 import PdfMerger
+except ImportError: # PyPDF2 < 1.28
+    from PyPDF2 import PdfFileMerger as PdfMerger
 from tqdm import tqdm
 
 import argparse
+import multiprocessing as mp
+import os
 import sys
 from sys import stderr
 import io
+import tempfile
 
-def one_page(id_str, template):
+def qr_path(matrix):
+    """SVG path data drawing the dark modules of a QR code matrix, one unit
+    per module, with each horizontal run of modules as a single rectangle."""
+    d = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < len(row) and row[x]:
+                x += 1
+            d.append(f"M{start},{y}h{x-start}v1h{start-x}z")
+    return "".join(d)
+
+
+def one_page(id_str, template, vector_qr=False):
+    """Render the page for id_str as a PDF. template is a loaded svglue
+    Template, which is cloned rather than changed. With vector_qr, QR codes
+    are drawn as paths rather than embedded as PNG images."""
     of = io.BytesIO()
-    tpl = svglue.load(file=template)
+    tpl = template.clone()
 
     tpl.set_text('id_text', id_str)
 
-    img_io = io.BytesIO()
     qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_H, box_size=20, border=0)
     qr.add_data(id_str)
     qr.make(fit=True)
-    img =  qr.make_image(fill_color="black", back_color="white")
-    img.save(img_io, "PNG")
+    if vector_qr:
+        matrix = qr.get_matrix()
+        path = qr_path(matrix)
+    else:
+        img_io = io.BytesIO()
+        img =  qr.make_image(fill_color="black", back_color="white")
+        img.save(img_io, "PNG")
     for img_key in tpl._rect_subs:
         if img_key.startswith("id_image"):
-            tpl.set_image(img_key, src=img_io.getvalue(), mimetype='image/png')
+            if vector_qr:
+                tpl.set_path(img_key, path, len(matrix), len(matrix))
+            else:
+                tpl.set_image(img_key, src=img_io.getvalue(), mimetype='image/png')
         else:
             print("WARNING: skipping rect with template-id", img_key, "as it doesn't start with 'id_image'. Check your SVG", file=stderr)
     cairosvg.svg2pdf(bytestring=str(tpl), write_to=of)
     return of
 
 
+# Each worker process's copy of the template and options, see _init_worker
+_worker_template = None
+_worker_vector_qr = False
+
+
+def _init_worker(template_path, vector_qr):
+    global _worker_template, _worker_vector_qr
+    _worker_template = svglue.load(file=template_path)
+    _worker_vector_qr = vector_qr
+
+
+def _render_chunk(job):
+    ids, tmpdir = job
+    merger = PdfMerger()
+    for id_str in ids:
+        merger.append(one_page(id_str, template=_worker_template, vector_qr=_worker_vector_qr))
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=tmpdir)
+    with os.fdopen(fd, "wb") as fh:
+        merger.write(fh)
+    merger.close()
+    return path, len(ids)
+
+
+def render_parallel(ids, template_path, output, threads, pages_per_chunk=25, vector_qr=False):
+    """Render a page per ID on `threads` processes, writing the PDF to
+    `output` with pages in the same order as `ids`. Workers merge chunks of
+    `pages_per_chunk` pages into temporary files, so page PDFs don't pile up
+    in memory while they wait to be merged in order."""
+    chunks = [ids[i:i+pages_per_chunk] for i in range(0, len(ids), pages_per_chunk)]
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            mp.Pool(threads, initializer=_init_worker, initargs=(template_path, vector_qr)) as pool:
+        merger = PdfMerger()
+        with tqdm(total=len(ids)) as progress:
+            for path, n in pool.imap(_render_chunk, [(chunk, tmpdir) for chunk in chunks]):
+                merger.append(path)
+                progress.update(n)
+        merger.write(output)
+        merger.close()
+
+
 
 def main():
     ap = argparse.ArgumentParser()
@@ -49,6 +122,12 @@ def main():
             help="First ID number (default 1)")
     ap.add_argument("--id-end", type=int, default=100, metavar="N",
             help="Last ID number (default 100)")
+    ap.add_argument("--threads", type=int, default=1, metavar="N",
+            help="Number of processes rendering pages (default 1)")
+    ap.add_argument("--pages-per-chunk", type=int, default=25, metavar="N",
+            help="Pages each process renders into one temporary PDF at a time, with --threads (default 25)")
+    ap.add_argument("--vector-qr", action="store_true",
+            help="Draw QR codes as vector paths rather than PNG images. Faster, smaller PDFs, and sharp at any resolution.")
     args = ap.parse_args()
 
     if args.id_file is None and args.id_format is None:
@@ -64,11 +143,16 @@ def main():
     else:
         ids = [args.id_format.format(i) for i in range(args.id_start, args.id_end+1)]
 
-    pdfmerge = PdfFileMerger()
+    ids = [id for id in ids if id != "." and id != ""]
+
+    if args.threads > 1:
+        render_parallel(ids, args.template, args.output, args.threads, args.pages_per_chunk,
+                        vector_qr=args.vector_qr)
+        return
+    template = svglue.load(file=args.template)
+    pdfmerge = PdfMerger()
     for id in tqdm(ids):
-        if id == "." or id == "":
-            continue
-        pdfmerge.append(one_page(id, template=args.template))
+        pdfmerge.append(one_page(id, template=template, vector_qr=args.vector_qr))
     pdfmerge.write(args.output)
 
 if __name__ == "__main__":
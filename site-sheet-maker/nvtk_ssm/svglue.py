@@ -28,6 +28,7 @@
 
 
 from base64 import b64encode
+from copy import deepcopy
 from uuid import uuid4
 
 from lxml import etree
@@ -37,6 +38,7 @@ RECT_TAG = '{http://www.w3.org/2000/svg}rect'
 TSPAN_TAG = '{http://www.w3.org/2000/svg}tspan'
 FLOWPARA_TAG = '{http://www.w3.org/2000/svg}flowPara'
 IMAGE_TAG = '{http://www.w3.org/2000/svg}image'
+PATH_TAG = '{http://www.w3.org/2000/svg}path'
 USE_TAG = '{http://www.w3.org/2000/svg}use'
 HREF_ATTR = '{http://www.w3.org/1999/xlink}href'
 
@@ -92,6 +94,21 @@ class Template(object):
                                                     etree.Element(
                                                         '{%s}defs' % SVG_NS))
 
+    def clone(self):
+        """Return an independent copy of this template, without re-parsing
+        the SVG. Load a template once and clone it for each page."""
+        doc = deepcopy(self._doc)
+        # The copy has the same structure, so walking both trees together
+        # pairs each element with its copy
+        copies = dict(zip(self._doc.iter(), doc.iter()))
+        tpl = self.__class__.__new__(self.__class__)
+        tpl._doc = doc
+        tpl._rect_subs = {tid: copies[elem] for tid, elem in self._rect_subs.items()}
+        tpl._tspan_subs = {tid: copies[elem] for tid, elem in self._tspan_subs.items()}
+        tpl._flowpara_subs = {tid: copies[elem] for tid, elem in self._flowpara_subs.items()}
+        tpl._defs = copies.get(self._defs)
+        return tpl
+
     def set_text(self, tid, text):
         self._tspan_subs[tid].text = text
 
@@ -129,6 +146,32 @@ class Template(object):
             encoded = b64encode(src).decode('ascii')
             elem.set(HREF_ATTR, 'data:%s;base64,%s' % (mimetype, encoded))
 
+    def set_path(self, tid, d, width, height, style='fill:#000000;stroke:none'):
+        """Replace a rect with a path, scaling path data `d` drawn in a
+        width x height box to fill the rect. Any transform on the rect
+        still applies."""
+        elem = self._rect_subs[tid]
+        try:
+            x = float(elem.get('x', 0))
+            y = float(elem.get('y', 0))
+            w = float(elem.get('width'))
+            h = float(elem.get('height'))
+        except (TypeError, ValueError):
+            raise TemplateParseError(
+                'Rect %s needs a numeric x, y, width and height to be replaced '
+                'by a path' % (tid, ))
+        transform = elem.get('transform', '')
+
+        elem.tag = PATH_TAG
+        for attr in elem.attrib.keys():
+            if attr != 'id':
+                del elem.attrib[attr]
+
+        elem.set('transform', ('%s translate(%r,%r) scale(%r,%r)' % (
+            transform, x, y, w / width, h / height)).strip())
+        elem.set('style', style)
+        elem.set('d', d)
+
     def set_svg(self, tid, src=None, file=None):
         if not (src == None) ^ (file == None):
             raise RuntimeError('Must specify exactly one of src or '